@@ -0,0 +1,174 @@
+'''
+Registro dos alocadores com uma interface única.
+
+Cada alocador é chamado como allocator(context, state) -> (weights, state), onde context é um
+pipeline.WindowContext e state é o que o próprio alocador devolveu na janela anterior (None na
+primeira janela ou sem warm start). Cada alocador declara o que usa do contexto (needs), as
+linkages de que precisa e se depende da seed da janela, e prepare() calcula só essas etapas,
+uma única vez, antes de rodar os alocadores pedidos.
+
+Para adicionar um método basta registrar uma função:
+
+    @register('meu_metodo', needs=('covariance',), linkages=('ward',))
+    def meu_metodo(context, state):
+        ...
+        return weights, state
+
+e variantes de um método existente (outros parâmetros, mesmo pré-processamento) com
+REGISTRY['HRB'].variant('HRB_g20', gamma=20).
+'''
+from dataclasses import dataclass, field, replace
+
+import numpy as np
+import pandas as pd
+
+import xmeans
+import hcaa
+import hrp
+import hrb
+import profiling
+
+
+@dataclass(frozen=True)
+class Allocator:
+    '''
+    Um método de alocação registrado.
+
+    Parameters
+    ----------
+    name: str
+        Nome do método, usado como coluna nos resultados
+    func: callable
+        func(context, state, **options) -> (weights, state)
+    needs: tuple
+        Atributos do WindowContext usados (correlation, distance, condensed, covariance, volatility)
+    linkages: tuple
+        Linkages usadas, obtidas com context.linkage(method, optimal_ordering): o nome do método
+        (com optimal_ordering) ou o par (método, optimal_ordering)
+    seeded: bool
+        Usa o gerador global do NumPy; a seed da janela é fixada antes da chamada
+    options: dict
+        Argumentos extras repassados para func
+    '''
+    name: str
+    func: object
+    needs: tuple = ()
+    linkages: tuple = ()
+    seeded: bool = False
+    options: dict = field(default_factory=dict)
+
+    def __call__(self, context, state=None):
+        return self.func(context, state, **self.options)
+
+    def variant(self, name, **options):
+        '''
+        Registra uma cópia deste alocador com outro nome e opções, com as mesmas dependências
+        '''
+        return _add(replace(self, name=name, options={**self.options, **options}))
+
+
+REGISTRY = {}
+
+def _add(allocator):
+    REGISTRY[allocator.name] = allocator
+    return allocator
+
+def register(name, needs=(), linkages=(), seeded=False, **options):
+    '''
+    Decorador que registra func(context, state, **options) -> (weights, state) como alocador
+    '''
+    def decorator(func):
+        _add(Allocator(name, func, tuple(needs), tuple(linkages), seeded, options))
+        return func
+    return decorator
+
+def get(names=None):
+    '''
+    Alocadores pelo nome, na ordem pedida; todos os registrados se names for None
+    '''
+    if names is None: names = list(REGISTRY)
+    missing = [name for name in names if name not in REGISTRY]
+    if missing:
+        raise KeyError(f'alocadores não registrados: {missing}; disponíveis: {list(REGISTRY)}')
+    return [REGISTRY[name] for name in names]
+
+def prepare(context, allocators):
+    '''
+    Calcula no contexto só as matrizes e linkages que os alocadores declaram, cada uma uma vez
+    '''
+    for need in dict.fromkeys(need for allocator in allocators for need in allocator.needs):
+        getattr(context, need)
+    for linkage in dict.fromkeys(linkage for allocator in allocators for linkage in allocator.linkages):
+        method, optimal_ordering = (linkage, True) if isinstance(linkage, str) else linkage
+        context.linkage(method, optimal_ordering)
+    return context
+
+def run(context, allocators, seed=None, states=None):
+    '''
+    Roda os alocadores sobre o mesmo contexto.
+
+    Parameters
+    ----------
+    context: pipeline.WindowContext
+        Contexto da janela
+    allocators: list
+        Alocadores (ver get)
+    seed: int
+        Seed fixada no gerador global antes de cada alocador com seeded=True, então o resultado
+        de um método não depende de quais outros rodam junto
+    states: dict
+        Estado de cada alocador na janela anterior, pelo nome
+
+    Return
+    ------
+    weights: list
+        Vetores de pesos na ordem de allocators
+    states: dict
+        Estado de cada alocador nesta janela, pelo nome
+    '''
+    states = states or {}
+    prepare(context, allocators)
+    weights, new_states = [], {}
+    for allocator in allocators:
+        if allocator.seeded and seed is not None: np.random.seed(seed)
+        with profiling.stage(f'allocator.{allocator.name}'):
+            w, new_states[allocator.name] = allocator(context, states.get(allocator.name))
+        weights.append(np.asarray(w, dtype=float))
+    return weights, new_states
+
+
+@register('x_means', needs=('condensed', 'covariance'), seeded=True)
+def x_means(context, state):
+    state = state or {}
+    asset = list(context.assets)
+    # seed None: o xmeans usa o estado global fixado em run
+    w, clusters = xmeans.main(context, context.covariance, asset, None, previous_weights=state.get('weights'),
+                              state=state.get('clusters'), return_state=True)
+    # os pesos do x_means estao na ordem de asset e servem de ponto inicial na janela seguinte
+    return w, {'weights': pd.Series(w, index=asset), 'clusters': clusters}
+
+@register('x_means_ensemble', needs=('condensed', 'covariance'), seeded=True, n_runs=20, max_workers=1)
+def x_means_ensemble(context, state, n_runs, max_workers):
+    state = state or {}
+    asset = list(context.assets)
+    # n_runs fits do X-Means combinados em clusters de consenso antes do peso; por padrao em
+    # sequencia (max_workers=1), porque o WalkForwardEngine ja usa um processo por nucleo
+    w, _ = xmeans.main(context, context.covariance, asset, None, previous_weights=state.get('weights'),
+                       return_state=True, n_runs=n_runs, max_workers=max_workers)
+    return w, {'weights': pd.Series(w, index=asset)}
+
+@register('HCAA', needs=('condensed',), linkages=('ward',))
+def hcaa_allocator(context, state):
+    return hcaa.main(context), None
+
+@register('HRP', needs=('condensed', 'covariance'), linkages=('ward',))
+def hrp_allocator(context, state):
+    return hrp.main(context), None
+
+@register('HRB', needs=('condensed', 'volatility'), linkages=(('single', False),), gamma=10, warm_start=False)
+def hrb_allocator(context, state, gamma, warm_start):
+    # o QP do HRB maximiza uma função convexa no simplex, então partir do vértice da janela
+    # anterior prende o SLSQP nele; o warm start dos budgets só roda quando pedido, com
+    # REGISTRY['HRB'].variant('HRB_warm', warm_start=True)
+    w, budgets = hrb.main(context, previous_budgets=state if warm_start else None, return_state=True, gamma=gamma)
+    return w, budgets if warm_start else None
@@ -0,0 +1,367 @@
+'''
+Backtest walk-forward dos alocadores (X-Means, HCAA, HRP e HRB).
+
+Os pesos de cada janela não dependem das outras janelas, somente o turnover precisa dos pesos
+da janela anterior. Por isso o WalkForwardEngine distribui as janelas em blocos para um
+pool de processos (workers.run_blocks) e calcula o turnover depois que todas as janelas terminam.
+'''
+import os
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+import allocators
+import pipeline
+import profiling
+import results
+import rolling
+import turnover
+import workers
+
+METHODS = ['x_means', 'HCAA', 'HRP', 'HRB']
+
+def get_composition(composition: pd.DataFrame, i: int, InS: int, date_ins: pd.Series) -> pd.Series:
+    # 1. Recorte das linhas
+    df_slice = composition.iloc[i:(InS - 1 + i)]
+    # 2. Filtra por data até a data final de interesse
+    df_filtered = df_slice[df_slice["dates"] <= date_ins.iloc[-1]]
+    # 3. Última linha do filtro
+    last_row = df_filtered.tail(1)
+    # 4. Remove a coluna "dates"
+    last_row_no_dates = last_row.drop(columns="dates")
+    # 5. Conta valores NaN por coluna
+    return last_row_no_dates.isna().sum()
+
+def calculate_to(previous_weights, desired_weights, oos_returns, p):
+    # Substitui NaNs por 0 nos retornos
+    oos_returns_ = oos_returns.fillna(0)
+
+    # Atualiza os pesos com base nos retornos
+    num = previous_weights * (1 + oos_returns_ / 100)
+    den = np.nansum(num)  # soma ignorando NaNs
+
+    updated_weights = num / den #if den != 0 else np.zeros_like(num)
+
+    # Calcula o turnover como soma das diferenças absolutas
+    t_o = np.sum(np.abs(desired_weights - updated_weights), axis=1)
+
+    return t_o.tolist()[0]
+
+def window_assets(stocks, composition, i, InS):
+    '''
+    Ativos elegíveis na janela i: fazem parte do IBRx na data final da janela e não têm
+    retornos faltantes dentro da janela.
+
+    Return
+    ------
+    aux: list
+        Tickers elegíveis
+    '''
+    # obtendo as datas que serao usadas nessa janela
+    date_ins = stocks.iloc[i:(InS - 1 + i), ]['dates']
+    # a funcao get_composition retorna a soma de valores nan na composicao do indice
+    aux1 = get_composition(composition, i, InS, date_ins)
+    # quantos valores nan tem as colunas de retorno dentro da janela
+    aux2 = stocks.iloc[i:(InS - 1 + i)].drop(columns="dates").isna().sum()
+    # aqui pega as colunas onde não existem nan em aux1 e aux2, depois pega a intersecao
+    # na ordem das colunas de stocks (a ordem de um set depende do hash das strings)
+    eligible = set(aux1[aux1 == 0].index).intersection(aux2[aux2 == 0].index)
+    return [ticker for ticker in aux2.index if ticker in eligible]
+
+class EligibilityIndex:
+    '''
+    Ativos elegíveis de todas as janelas, calculados de uma vez.
+
+    Para cada janela i (linhas i, ..., i + InS - 2, como em window_assets) o ativo é elegível se
+    não tem retorno faltante nessas linhas e se está na composição do IBRx da última linha de
+    composition.iloc[i:InS - 1 + i] com data até o fim da janela. A contagem de NaN vem de uma
+    soma acumulada da máscara de NaN e a linha da composição de um searchsorted nas datas, então
+    a lista de cada janela é uma consulta de linha na máscara.
+
+    Parameters
+    ----------
+    stocks: dataframe pandas
+        Retornos mensais com a coluna 'dates' seguida de uma coluna por ticker
+    composition: dataframe pandas
+        Composição do IBRx com a coluna 'dates' (em ordem crescente) seguida de uma coluna por ticker
+    InS: int
+        Tamanho da janela dentro da amostra
+    '''
+    def __init__(self, stocks, composition, InS=120):
+        self.tickers = stocks.columns.drop('dates')
+        n_windows = max(stocks.shape[0] - InS, 0)
+        starts = np.arange(n_windows)
+        ends = starts + InS - 1 # fim exclusivo das linhas da janela
+
+        # NaN de cada ativo nas linhas [i, i + InS - 1), por diferenca da soma acumulada
+        missing = stocks[self.tickers].isna().to_numpy()
+        cumulative = np.zeros((missing.shape[0] + 1, missing.shape[1]), dtype=np.int64)
+        np.cumsum(missing, axis=0, out=cumulative[1:])
+        complete = cumulative[ends] == cumulative[starts]
+
+        # ultima linha da composicao dentro de [i, i + InS - 1) com data ate o fim da janela
+        end_dates = stocks['dates'].to_numpy()[ends - 1]
+        last = np.minimum(np.searchsorted(composition['dates'].to_numpy(), end_dates, side='right'), ends) - 1
+        member = composition.drop(columns='dates').reindex(columns=self.tickers).notna().to_numpy()
+        # sem nenhuma linha o get_composition nao encontra NaN: todos os ativos da composicao entram
+        listed = np.broadcast_to(self.tickers.isin(composition.columns), member.shape[1:])
+        in_index = np.where((last >= starts)[:, None], member[np.maximum(last, 0)], listed)
+
+        self.mask = complete & in_index
+        self._assets = {}
+
+    def __len__(self):
+        return self.mask.shape[0]
+
+    def assets(self, i):
+        '''
+        Tickers elegíveis na janela i, na ordem das colunas de stocks
+        '''
+        if i not in self._assets:
+            self._assets[i] = self.tickers[self.mask[i]].tolist()
+        return self._assets[i]
+
+def allocate_window(retu_ins, i, previous=None, moments=None, methods=None):
+    '''
+    Calcula os pesos dos alocadores para os retornos dentro da amostra de uma janela.
+
+    A seed global é fixada em i antes de cada alocador que usa o gerador aleatório, do mesmo
+    jeito que o laço do notebook fazia com np.random.seed(i), então o resultado de cada janela
+    não depende de qual processo a executa nem de quais outros métodos rodam junto.
+
+    Parameters
+    ----------
+    retu_ins: dataframe pandas
+        Retornos dentro da amostra dos ativos elegíveis
+    i: int
+        Índice da janela
+    previous: dict
+        Estado da janela anterior devolvido em carry, usado como ponto inicial dos
+        otimizadores e do X-Means; None parte da inicialização padrão
+    moments: rolling.RollingMoments
+        Somas da janela anterior, atualizadas de forma incremental para obter a correlação e
+        a covariância; None recalcula com retu_ins.corr() e retu_ins.cov()
+    methods: list
+        Nomes dos alocadores registrados em allocators.REGISTRY, METHODS se None
+
+    Return
+    ------
+    weights: list
+        Vetores de pesos na ordem de methods
+    carry: dict
+        Estado desta janela (por método) para ser passado como previous na janela seguinte
+    '''
+    context = pipeline.build_context(retu_ins, moments=moments)
+    return allocators.run(context, allocators.get(methods or METHODS), seed=i, states=previous)
+
+# Estado de cada processo do pool, preenchido uma unica vez por _setup_worker (via
+# workers.run_blocks) para que os retornos nao sejam serializados junto com cada bloco
+_worker = {}
+
+def _setup_worker(stocks, InS, options):
+    _worker.update(stocks=stocks, InS=InS, **options)
+    if options['profile']: profiling.enable(memory=options['profile_memory'])
+    # linkages persistidas em disco sao compartilhadas entre os processos e entre execucoes
+    if options['linkage_cache_dir'] is not None and pipeline.linkage_cache.path != options['linkage_cache_dir']:
+        pipeline.configure_linkage_cache(path=options['linkage_cache_dir'])
+
+def _run_block(block):
+    stocks = _worker['stocks']; InS = _worker['InS']
+    block_results = []
+    previous = None
+    # as janelas de um bloco sao consecutivas, entao as somas deslizam de uma para outra
+    moments = rolling.RollingMoments() if _worker['rolling'] else None
+    for i, aux in block:
+        # com profile cada janela comeca uma nova coleta do profiling
+        if _worker['profile']: profiling.reset()
+        with profiling.stage('window'):
+            retu_ins = stocks.iloc[i:(InS - 1 + i)][aux]
+            w_window, carry = allocate_window(retu_ins, i, previous, moments, _worker['methods'])
+        if _worker['warm_start']: previous = carry
+        block_results.append((i, w_window, profiling.snapshot(reset=True) if _worker['profile'] else None))
+    return block_results
+
+
+@dataclass
+class BacktestResult:
+    '''
+    Resultado do backtest. Rport, sspw, weights e r_oos são DataFrames no mesmo formato do
+    notebook, criados sob demanda como visões sobre os arrays do ResultStore.
+
+    Parameters
+    ----------
+    store: results.ResultStore
+        Arrays com retorno, concentração, pesos e retornos fora da amostra de todas as janelas
+    to: dataframe pandas
+        Turnover, indexado por i - 1 para a janela i
+    timings: dataframe pandas
+        Com profile=True, tempo, chamadas, pico de memória e iterações de cada etapa por
+        janela (índice (window, stage), ver profiling.timing_table); None sem profile
+    '''
+    store: results.ResultStore
+    to: pd.DataFrame
+    timings: pd.DataFrame = None
+
+    @property
+    def Rport(self):
+        # Retorno fora da amostra do portfólio, janelas x métodos
+        return self.store.rport_frame()
+
+    @property
+    def sspw(self):
+        # Soma dos pesos ao quadrado (concentração), janelas x métodos
+        return self.store.sspw_frame()
+
+    @property
+    def weights(self):
+        # Para cada método, DataFrame janelas x tickers com os pesos (NaN fora do universo)
+        return {method: self.store.weights_frame(method) for method in self.store.methods}
+
+    @property
+    def r_oos(self):
+        # Retornos fora da amostra de cada janela, janelas x tickers
+        return self.store.r_oos_frame()
+
+    def turnover_report(self, cost=0.0):
+        '''
+        Turnover de ida e volta e de ida e retornos líquidos de um custo de transação por
+        unidade de peso negociada (ver turnover.turnover_report)
+        '''
+        return turnover.turnover_report(self.store, cost)
+
+    def stage_totals(self):
+        '''
+        Tempo total, chamadas e contadores de cada etapa somados sobre as janelas, com o pico
+        de memória máximo, ordenados pelo tempo
+        '''
+        if self.timings is None: return None
+        totals = self.timings.groupby(level='stage').sum(min_count=1)
+        totals['peak_kb'] = self.timings['peak_kb'].groupby(level='stage').max()
+        return totals.sort_values('seconds', ascending=False)
+
+
+class WalkForwardEngine:
+    '''
+    Executa o backtest walk-forward distribuindo as janelas entre processos.
+
+    Parameters
+    ----------
+    stocks: dataframe pandas
+        Retornos mensais com a coluna 'dates' seguida de uma coluna por ticker
+    composition: dataframe pandas
+        Composição do IBRx com a coluna 'dates' seguida de uma coluna por ticker
+    InS: int
+        Tamanho da janela dentro da amostra
+    max_workers: int
+        Quantidade de processos, os.cpu_count() se None; com 1 roda no próprio processo
+    chunksize: int
+        Quantidade de janelas consecutivas enviadas a um processo por vez
+    warm_start: bool
+        Inicia o otimizador do X-Means com os pesos e os clusters da janela anterior (o HRB só
+        usa os budgets anteriores na variante com warm_start=True, ver
+        allocators.hrb_allocator). O estado é carregado dentro
+        de cada bloco de chunksize janelas, então o resultado depende de chunksize, mas não
+        de max_workers
+    rolling: bool
+        Atualiza correlação e covariância de forma incremental entre as janelas de um bloco
+        com rolling.RollingMoments, em vez de recalcular a partir de todas as linhas
+    verbose: bool
+        Imprime o progresso conforme os blocos terminam
+    spill_dir: str
+        Pasta onde os resultados são gravados em arrays mapeados em memória (execuções longas);
+        None mantém os resultados em memória
+    methods: list
+        Alocadores registrados em allocators.REGISTRY que serão executados, METHODS se None;
+        o contexto de cada janela calcula só o que esses alocadores usam
+    linkage_cache_dir: str
+        Pasta onde as linkages são persistidas (pipeline.configure_linkage_cache), para que uma
+        nova execução do mesmo backtest não refaça o clustering; None mantém só em memória
+    profile: bool
+        Liga o profiling em cada processo e devolve em BacktestResult.timings o tempo de cada
+        etapa (contexto, linkages, árvores, otimizadores) por janela; exportar com
+        result.timings.to_csv(...)
+    profile_memory: bool
+        Com profile, mede também o pico de memória de cada etapa (tracemalloc, bem mais lento)
+    '''
+    def __init__(self, stocks, composition, InS=120, max_workers=None, chunksize=4, warm_start=False,
+                 rolling=False, verbose=True, spill_dir=None, methods=None, linkage_cache_dir=None,
+                 profile=False, profile_memory=False):
+        self.stocks = stocks
+        self.composition = composition
+        self.InS = InS
+        self.OoS = stocks.shape[0] - InS
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.chunksize = max(int(chunksize), 1)
+        self.warm_start = warm_start
+        self.rolling = rolling
+        self.verbose = verbose
+        self.spill_dir = spill_dir
+        self.linkage_cache_dir = linkage_cache_dir
+        self.profile = profile
+        self.profile_memory = profile_memory
+        self.methods = [allocator.name for allocator in allocators.get(methods or METHODS)]
+
+    def windows(self):
+        '''
+        Lista de (i, aux) para todas as janelas, a partir de um EligibilityIndex calculado uma
+        única vez no processo principal.
+        '''
+        eligibility = EligibilityIndex(self.stocks, self.composition, self.InS)
+        return [(i, eligibility.assets(i)) for i in range(self.OoS)]
+
+    def _options(self):
+        return {'warm_start': self.warm_start, 'rolling': self.rolling, 'methods': self.methods,
+                'linkage_cache_dir': self.linkage_cache_dir, 'profile': self.profile,
+                'profile_memory': self.profile_memory}
+
+    def _blocks(self, windows):
+        return workers.split_blocks(windows, self.chunksize)
+
+    def _allocate(self, windows):
+        was_profiling = profiling.is_enabled()
+        previous_cache = pipeline.linkage_cache
+        try:
+            for block in workers.run_blocks(_run_block, self._blocks(windows), self.max_workers, _setup_worker,
+                                            (self.stocks, self.InS, self._options())):
+                self._report(block)
+                yield from block
+        finally:
+            # com max_workers=1 o _setup_worker roda no proprio processo: o profiling e o
+            # linkage_cache voltam ao estado de antes do backtest
+            if self.max_workers == 1:
+                if self.profile and not was_profiling: profiling.disable()
+                pipeline.linkage_cache = previous_cache
+
+    def _report(self, block):
+        if self.verbose:
+            print(f'backtest: janelas {block[0][0]} a {block[-1][0]} concluidas')
+
+    def run(self):
+        '''
+        Roda todas as janelas e remonta Rport, sspw, to e os pesos por ticker em ordem.
+
+        Return
+        ------
+        result: BacktestResult
+        '''
+        windows = self.windows()
+        tickers = self.stocks.columns.drop('dates')
+        store = results.ResultStore(self.OoS, self.methods, tickers, path=self.spill_dir)
+        returns = self.stocks[tickers].to_numpy(dtype=float)
+
+        assets = dict(windows)
+        timings = {}
+        for i, w_window, window_timings in self._allocate(windows):
+            if window_timings is not None: timings[i] = window_timings
+            aux = assets[i]
+            # retorno no mes seguinte a janela, fora da amostra
+            r_oos = returns[self.InS + i, tickers.get_indexer(aux)]
+            store.record(i, aux, w_window, r_oos)
+        store.flush()
+
+        # turnover depende da janela anterior, por isso e calculado depois de todas as janelas,
+        # de uma vez sobre os arrays do store (mesmas contas do calculate_to, a partir de i = 3)
+        to = turnover.turnover_frame(store, min_window=3)
+        return BacktestResult(store=store, to=to,
+                              timings=profiling.timing_table(timings) if self.profile else None)
@@ -0,0 +1,282 @@
+'''
+Benchmark dos quatro alocadores e das etapas do pipeline em retornos sintéticos.
+
+Cada caso da grade n_assets x T gera retornos com synthetic.factor_returns e mede, com
+time.perf_counter, o menor e a mediana de --repeat execuções de cada benchmark. O preparo
+de cada benchmark (contexto, linkage, matriz s_barra, ...) fica fora do tempo medido e é
+refeito a cada execução, e os caches de linkage e de quasi-diagonal são desligados, então
+nenhuma execução aproveita o trabalho da anterior.
+
+Uso, a partir de backtest_xmeans-main:
+
+    python benchmarks/bench_allocators.py                       # grade completa
+    python benchmarks/bench_allocators.py --assets 20 100 --windows 120 --only hrp.main
+    python benchmarks/bench_allocators.py --save-baseline       # grava benchmarks/baseline.json
+    python benchmarks/bench_allocators.py --baseline benchmarks/baseline.json
+
+Os resultados vão para benchmarks/results/<data>.json. Com --baseline cada caso é comparado
+com o mesmo caso do baseline e o script sai com código 1 se algum ficou mais lento que
+--tolerance (relativo) e --min-delta (absoluto, em segundos).
+
+Antes de cada caso o tempo é estimado a partir do caso anterior do mesmo benchmark e do
+mesmo T, supondo crescimento cúbico em n_assets (o pior entre as linkages e os SLSQP); se a
+estimativa passa de --budget segundos o caso e os maiores são pulados (status 'skipped').
+O SLSQP do HRB, por exemplo, leva ~15 s com 500 ativos e não roda com 2000.
+'''
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+from datetime import datetime
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import scipy
+import sklearn
+import scipy.cluster.hierarchy as hr
+
+import hcaa
+import hrb
+import hrp
+import pipeline
+import xmeans
+from synthetic import factor_returns
+
+ASSETS = [20, 100, 500, 2000]
+WINDOWS = [60, 120, 240]
+
+
+def _context(returns):
+    return pipeline.build_context(returns)
+
+def _with_condensed(returns):
+    # etapas que partem da correlação já calculada
+    context = _context(returns)
+    context.correlation
+    return context
+
+def _with_linkage(method, optimal_ordering=True):
+    def setup(returns):
+        return hr.linkage(_context(returns).condensed, method=method, optimal_ordering=optimal_ordering)
+    return setup
+
+def _hrb_s_barra(returns):
+    context = _context(returns)
+    link = context.linkage('single', optimal_ordering=False)
+    return hrb.f(hrb.construir_matriz_similaridade(link, list(context.assets)))
+
+def _xmeans_distance(returns):
+    return _context(returns).square_distance()
+
+def _xmeans_clusters(returns):
+    context = _context(returns)
+    fit = xmeans.XMeans().fit(context.square_distance(), 0)
+    return fit['cluster'], context.covariance
+
+def _sorted_covariance(returns):
+    context = _context(returns)
+    order = hrp.quasi_diag_order(context.linkage('ward'))
+    return context.covariance[np.ix_(order, order)]
+
+
+# nome -> (preparo fora do tempo medido, função medida sobre o resultado do preparo)
+BENCHMARKS = {
+    # alocadores de ponta a ponta, a partir dos retornos da janela
+    'xmeans.main': (_context, lambda context: xmeans.main(context, seed=0)),
+    'hcaa.main': (_context, hcaa.main),
+    'hrp.main': (_context, hrp.main),
+    'hrb.main': (_context, hrb.main),
+    # etapas do pipeline
+    'stage.correlation': (_context, lambda context: context.correlation),
+    'stage.pdist': (_with_condensed, lambda context: context.condensed),
+    'stage.linkage_ward': (lambda returns: _context(returns).condensed,
+                           lambda condensed: hr.linkage(condensed, method='ward', optimal_ordering=True)),
+    'stage.linkage_single': (lambda returns: _context(returns).condensed,
+                             lambda condensed: hr.linkage(condensed, method='single')),
+    'stage.quasi_diag': (_with_linkage('ward'), hrp.quasi_diag_order),
+    'stage.recursive_bisection': (_sorted_covariance, hrp.recursive_bisection_weights),
+    'stage.hcaa_tree': (_with_linkage('ward'), lambda link: hcaa.ArrayTree.from_linkage(link, 100).leaf_weights()),
+    'stage.hrb_similarity': (_with_linkage('single', optimal_ordering=False),
+                             lambda link: hrb.construir_matriz_similaridade(link, list(range(len(link) + 1)))),
+    'stage.hrb_optimization': (_hrb_s_barra, lambda s_barra: hrb.resolver_otimizacao(s_barra, [10], batched=True)),
+    'stage.xmeans_fit': (_xmeans_distance, lambda X: xmeans.XMeans().fit(X, 0)),
+    'stage.xmeans_fit_lloyd': (_xmeans_distance, lambda X: xmeans.XMeans(split_engine='lloyd').fit(X, 0)),
+    'stage.xmeans_optimization': (_xmeans_clusters, lambda args: xmeans.XMeans().peso(*args)),
+}
+
+
+def _reset_caches():
+    pipeline.configure_linkage_cache(maxsize=0)
+    hrp._quasi_diag_cache.clear()
+
+def time_benchmark(name, returns, repeat=3):
+    '''
+    Tempos de repeat execuções de um benchmark, cada uma com o seu preparo fora do tempo
+
+    Return
+    ------
+    times: list
+        Segundos de cada execução
+    '''
+    setup, func = BENCHMARKS[name]
+    times = []
+    for _ in range(repeat):
+        _reset_caches()
+        args = setup(returns)
+        start = time.perf_counter()
+        func(args)
+        times.append(time.perf_counter() - start)
+    return times
+
+def run(assets=ASSETS, windows=WINDOWS, names=None, repeat=3, budget=60.0, seed=0, log=print):
+    '''
+    Roda a grade de benchmarks.
+
+    Parameters
+    ----------
+    assets: list
+        Quantidades de ativos
+    windows: list
+        Tamanhos T da janela (meses)
+    names: list
+        Benchmarks a rodar, todos de BENCHMARKS se None
+    repeat: int
+        Execuções de cada caso
+    budget: float
+        Tempo estimado de uma execução, em segundos, a partir do qual o caso é pulado
+    seed: int
+        Seed dos retornos sintéticos
+    log: callable
+        Recebe uma linha de texto por caso
+
+    Return
+    ------
+    report: dict
+        'meta' (versões, máquina e parâmetros) e 'results' (uma entrada por caso)
+    '''
+    import warnings
+    names = list(BENCHMARKS) if names is None else list(names)
+    results = []
+    # ultimo (n_assets, tempo) medido de cada (benchmark, T), para estimar o caso seguinte
+    last = {}
+    for T in windows:
+        for n_assets in sorted(assets):
+            returns = factor_returns(n_assets, T, seed=seed)
+            for name in names:
+                case = {'benchmark': name, 'n_assets': n_assets, 'T': T}
+                if (name, T) in last:
+                    previous_n, previous_time = last[(name, T)]
+                    estimate = previous_time * (n_assets / previous_n) ** 3
+                    if estimate > budget:
+                        results.append({**case, 'status': 'skipped', 'estimate': estimate})
+                        log(f'{name:28s} n={n_assets:<5d} T={T:<4d} pulado (estimativa {estimate:.0f}s)')
+                        last[(name, T)] = (n_assets, estimate)
+                        continue
+                try:
+                    with warnings.catch_warnings():
+                        warnings.simplefilter('ignore')
+                        times = time_benchmark(name, returns, repeat)
+                except Exception as error:
+                    results.append({**case, 'status': 'error', 'error': f'{type(error).__name__}: {error}'})
+                    log(f'{name:28s} n={n_assets:<5d} T={T:<4d} erro: {type(error).__name__}')
+                    continue
+                results.append({**case, 'status': 'ok', 'min': min(times), 'median': float(np.median(times)),
+                                'times': times})
+                log(f'{name:28s} n={n_assets:<5d} T={T:<4d} min {min(times):10.4f}s  mediana {np.median(times):10.4f}s')
+                last[(name, T)] = (n_assets, min(times))
+    meta = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'scipy': scipy.__version__,
+        'sklearn': sklearn.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'assets': sorted(assets),
+        'windows': list(windows),
+        'repeat': repeat,
+        'budget': budget,
+        'seed': seed,
+    }
+    return {'meta': meta, 'results': results}
+
+def compare(report, baseline, tolerance=0.25, min_delta=0.005):
+    '''
+    Compara os tempos mínimos de report com os do baseline, caso a caso.
+
+    Parameters
+    ----------
+    report, baseline: dict
+        Saídas de run (ou os JSON gravados)
+    tolerance: float
+        Aumento relativo tolerado (0.25 = 25% mais lento)
+    min_delta: float
+        Aumento absoluto, em segundos, abaixo do qual a diferença é tratada como ruído
+
+    Return
+    ------
+    rows: list
+        Uma entrada por caso presente nos dois, com 'ratio' (atual / baseline) e 'regression'
+    '''
+    key = lambda result: (result['benchmark'], result['n_assets'], result['T'])
+    previous = {key(result): result for result in baseline['results'] if result['status'] == 'ok'}
+    rows = []
+    for result in report['results']:
+        old = previous.get(key(result))
+        if result['status'] != 'ok' or old is None: continue
+        ratio = result['min'] / old['min'] if old['min'] > 0 else np.inf
+        regression = ratio > 1 + tolerance and result['min'] - old['min'] > min_delta
+        rows.append({'benchmark': result['benchmark'], 'n_assets': result['n_assets'], 'T': result['T'],
+                     'baseline': old['min'], 'current': result['min'], 'ratio': ratio, 'regression': regression})
+    return rows
+
+def save(report, path):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump(report, file, indent=2)
+
+def load(path):
+    with open(path, encoding='utf-8') as file:
+        return json.load(file)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--assets', type=int, nargs='+', default=ASSETS, help='quantidades de ativos')
+    parser.add_argument('--windows', type=int, nargs='+', default=WINDOWS, help='tamanhos T da janela')
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS), help='benchmarks a rodar')
+    parser.add_argument('--repeat', type=int, default=3, help='execuções de cada caso')
+    parser.add_argument('--budget', type=float, default=60.0,
+                        help='tempo estimado, em segundos, a partir do qual um caso é pulado')
+    parser.add_argument('--seed', type=int, default=0, help='seed dos retornos sintéticos')
+    parser.add_argument('--output', help='JSON de saída, benchmarks/results/<data>.json se omitido')
+    parser.add_argument('--baseline', help='JSON de um run anterior para comparar')
+    parser.add_argument('--save-baseline', action='store_true', help='grava também benchmarks/baseline.json')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='aumento relativo tolerado')
+    parser.add_argument('--min-delta', type=float, default=0.005, help='aumento absoluto tolerado, em segundos')
+    args = parser.parse_args(argv)
+
+    report = run(args.assets, args.windows, args.only, args.repeat, args.budget, args.seed)
+    output = args.output or os.path.join(HERE, 'results', datetime.now().strftime('%Y%m%d-%H%M%S') + '.json')
+    save(report, output)
+    print(f'resultados em {output}')
+    if args.save_baseline:
+        save(report, os.path.join(HERE, 'baseline.json'))
+
+    if args.baseline:
+        rows = compare(report, load(args.baseline), args.tolerance, args.min_delta)
+        for row in rows:
+            flag = '  REGRESSAO' if row['regression'] else ''
+            print(f"{row['benchmark']:28s} n={row['n_assets']:<5d} T={row['T']:<4d} "
+                  f"{row['baseline']:10.4f}s -> {row['current']:10.4f}s  x{row['ratio']:.2f}{flag}")
+        if any(row['regression'] for row in rows):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
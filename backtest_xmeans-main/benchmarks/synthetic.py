@@ -0,0 +1,45 @@
+'''
+Retornos sintéticos de um modelo de fatores, para medir os alocadores sem as planilhas.
+
+    r = beta * mercado + carga * setor + ruído
+
+Cada ativo pertence a um setor, então a correlação tem blocos como a do IBRx e as linkages
+e o X-Means encontram clusters de verdade. Os retornos são mensais em %, como os da
+Economatica.
+'''
+import numpy as np
+import pandas as pd
+
+
+def factor_returns(n_assets, T, n_sectors=None, seed=0, market_vol=6.0, sector_vol=4.0, idio_vol=8.0):
+    '''
+    Retornos de n_assets ativos em T meses.
+
+    Parameters
+    ----------
+    n_assets: int
+        Quantidade de ativos
+    T: int
+        Quantidade de meses (linhas)
+    n_sectors: int
+        Quantidade de setores, round(sqrt(n_assets)) se None
+    seed: int
+        Seed do np.random.RandomState
+    market_vol, sector_vol, idio_vol: float
+        Volatilidade mensal em % do fator de mercado, dos fatores de setor e do ruído
+
+    Return
+    ------
+    returns: dataframe pandas
+        T x n_assets, colunas A0000, A0001, ...
+    '''
+    rng = np.random.RandomState(seed)
+    n_sectors = n_sectors or max(int(round(np.sqrt(n_assets))), 1)
+    sector = rng.randint(n_sectors, size=n_assets)
+    beta = rng.uniform(0.5, 1.5, size=n_assets)
+    loading = rng.uniform(0.5, 1.5, size=n_assets)
+    market = rng.normal(0.8, market_vol, size=(T, 1))
+    sectors = rng.normal(0.0, sector_vol, size=(T, n_sectors))
+    noise = rng.normal(0.0, idio_vol, size=(T, n_assets)) * rng.uniform(0.5, 1.5, size=n_assets)
+    returns = market * beta + sectors[:, sector] * loading + noise
+    return pd.DataFrame(returns, columns=[f'A{j:04d}' for j in range(n_assets)])
@@ -0,0 +1,121 @@
+'''
+Caches para resultados derivados de matrizes (ordem quasi-diagonal, linkage, ...).
+
+As chaves são calculadas a partir do conteúdo dos arrays, então duas janelas com a mesma matriz
+reaproveitam o mesmo resultado mesmo que os objetos sejam diferentes.
+'''
+import hashlib
+import os
+from collections import OrderedDict
+
+import numpy as np
+import scipy.cluster.hierarchy as hr
+
+
+def array_key(array, *extra):
+    '''
+    Chave estável para o conteúdo de um array: dtype, shape e hash sha1 dos bytes.
+
+    Parameters
+    ----------
+    array: ndarray
+        Array usado na chave
+    extra:
+        Valores adicionais (método, flags, ...) que também diferenciam o resultado
+
+    Return
+    ------
+    key: tuple
+    '''
+    array = np.ascontiguousarray(array)
+    digest = hashlib.sha1(array.view(np.uint8)).hexdigest()
+    return (array.dtype.str, array.shape, digest) + extra
+
+
+class LRUCache:
+    '''
+    Dicionário com tamanho máximo que descarta a entrada usada há mais tempo.
+
+    Parameters
+    ----------
+    maxsize: int
+        Quantidade máxima de entradas; None não tem limite
+    '''
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        if key in self._data:
+            self._data.move_to_end(key)
+            self.hits += 1
+            return self._data[key]
+        self.misses += 1
+        return default
+
+    def put(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if self.maxsize is not None:
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        return value
+
+    def clear(self):
+        self._data.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+class LinkageCache:
+    '''
+    Cache de linkage matrices do scipy, indexado pelo conteúdo da distância condensada, pelo
+    método e por optimal_ordering.
+
+    O HRP e o HCAA usam a mesma linkage 'ward' sobre a mesma distância, e o optimal_ordering
+    custa O(n³); com o cache cada linkage é calculada uma única vez. Com path as linkages também
+    são gravadas como .npy, então uma nova execução do mesmo backtest não refaz o clustering.
+
+    Parameters
+    ----------
+    maxsize: int
+        Quantidade de linkages mantidas em memória (LRU)
+    path: str
+        Pasta para persistir as linkages em disco; None mantém só em memória
+    '''
+    def __init__(self, maxsize=1024, path=None):
+        self.memory = LRUCache(maxsize)
+        self.path = path
+        if path is not None: os.makedirs(path, exist_ok=True)
+        self.computed = 0
+
+    def _file(self, key):
+        return os.path.join(self.path, hashlib.sha1(repr(key).encode()).hexdigest() + '.npy')
+
+    def linkage(self, condensed, method, optimal_ordering=True):
+        '''
+        Mesma saída de hr.linkage(condensed, method=method, optimal_ordering=optimal_ordering)
+        '''
+        key = array_key(np.asarray(condensed, dtype=float), method, bool(optimal_ordering))
+        link = self.memory.get(key)
+        if link is not None:
+            return link
+        if self.path is not None and os.path.exists(self._file(key)):
+            return self.memory.put(key, np.load(self._file(key)))
+        link = hr.linkage(condensed, method=method, optimal_ordering=optimal_ordering)
+        self.computed += 1
+        if self.path is not None:
+            # grava em um arquivo temporario e renomeia, varios processos podem escrever a mesma chave
+            tmp = f'{self._file(key)}.{os.getpid()}.tmp'
+            with open(tmp, 'wb') as file:
+                np.save(file, link)
+            os.replace(tmp, self._file(key))
+        return self.memory.put(key, link)
@@ -0,0 +1,227 @@
+'''
+Leitura das planilhas de entrada (retornos da Economatica e composição do IBRx) com cache em disco.
+
+Ler os .xlsx com pd.read_excel domina o início do notebook. Aqui a normalização (meses em
+português, renomeação das colunas, melt/pivot da composição) é feita uma única vez e o resultado
+fica em data/cache como arrays .npy (valores float64 e datas) mais um sidecar JSON com os
+tickers, o índice e a identificação dos arquivos de origem. As próximas leituras usam
+np.load(mmap_mode='r'), sem copiar os valores.
+
+O cache é invalidado automaticamente quando o arquivo de origem muda: tamanho e mtime iguais
+aceitam o cache direto; se mudarem, o sha256 do arquivo decide se é preciso refazer.
+'''
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+RAW_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'raw')
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'cache')
+
+STOCKS_FILE = 'economatica_b3.xlsx'
+COMPOSITION_FILE = 'composicao_IBRx.xlsx'
+
+# versao da normalizacao; mudar quando normalize_* mudar para invalidar os caches antigos
+CACHE_VERSION = 1
+
+MESES_PT = {
+    "Jan": "01", "Fev": "02", "Mar": "03", "Abr": "04", "Mai": "05", "Jun": "06",
+    "Jul": "07", "Ago": "08", "Set": "09", "Out": "10", "Nov": "11", "Dez": "12"
+}
+
+def normalize_composition(composition):
+    '''
+    Composição do IBRx em formato wide: coluna 'dates' seguida de uma coluna por ticker.
+
+    Parameters
+    ----------
+    composition: dataframe pandas
+        Planilha composicao_IBRx.xlsx como lida pelo pd.read_excel
+    '''
+    # 2. Remove colunas "Company" e "Type"
+    composition = composition.drop(columns=["Company", "Type"])
+    # 3. Transforma de wide para long
+    date_cols = composition.columns.difference(['Code'], sort=False)
+    composition_long = composition.melt(
+        id_vars='Code',
+        value_vars=date_cols,
+        var_name='Date',
+        value_name='valores'
+    )
+    # 4. Converte as datas (formato "Dec-97") para datetime com mês e ano
+    composition_long['dates'] = pd.to_datetime(
+        composition_long['Date'], format='%b-%y'
+    )
+    # 5. Remove a coluna original "Date" e reordena
+    composition_long = composition_long.drop(columns='Date')
+    composition_long = composition_long[['dates', 'Code', 'valores']]
+    # 6. Transforma de long para wide (tipo pivot_wider)
+    composition_wide = composition_long.pivot(
+        index='dates',
+        columns='Code',
+        values='valores'
+    ).reset_index()
+    return composition_wide.copy()
+
+def normalize_stocks(stocks, start="1997-12-01", end="2023-12-01"):
+    '''
+    Retornos mensais: coluna 'dates' seguida de uma coluna por ticker, com '-' trocado por NaN.
+
+    Parameters
+    ----------
+    stocks: dataframe pandas
+        Planilha economatica_b3.xlsx como lida pelo pd.read_excel
+    start, end: str
+        Intervalo de datas mantido
+    '''
+    # 2. Substituir os nomes dos meses em português por números
+    for pt, num in MESES_PT.items():
+        stocks["Data"] = stocks["Data"].str.replace(pt, num, regex=False)
+
+    # 3. Converter para datetime (assumindo formato "MM-YYYY" após substituições)
+    stocks["dates"] = pd.to_datetime(stocks["Data"], format="%m-%Y")
+
+    # 4. Reorganizar colunas e remover a original
+    stocks = stocks.drop(columns="Data")
+    stocks = stocks[["dates"] + [col for col in stocks.columns if col != "dates"]]
+
+    # 5. Filtrar intervalo de datas
+    stocks = stocks[(stocks["dates"] >= start) & (stocks["dates"] <= end)]
+
+    # 6. Renomear colunas removendo prefixo repetitivo
+    stocks.columns = stocks.columns.str.replace(
+        r"Retorno\ndo fechamento\nem 1 meses\nEm moeda orig\najust p/ prov\n", "", regex=True
+    )
+    stocks = stocks.replace("-", np.nan)
+    return stocks
+
+def file_signature(path, sha256=True):
+    '''
+    Identificação do arquivo de origem: tamanho, mtime e (opcionalmente) o sha256 do conteúdo
+    '''
+    stat = os.stat(path)
+    signature = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    if sha256:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b''):
+                digest.update(block)
+        signature['sha256'] = digest.hexdigest()
+    return signature
+
+def _cache_is_valid(meta, path):
+    '''
+    Confere o cache contra o arquivo de origem. Quando só o mtime mudou e o sha256 confere,
+    meta['source'] recebe a nova identificação (para o próximo load não refazer o hash) e a
+    função devolve 'touched'; 'valid' quando tamanho e mtime batem; False quando o cache não vale
+    '''
+    if meta.get('version') != CACHE_VERSION:
+        return False
+    cached = meta['source']
+    current = file_signature(path, sha256=False)
+    if current['size'] == cached['size'] and current['mtime_ns'] == cached['mtime_ns']:
+        return 'valid'
+    # o arquivo foi tocado: so refaz se o conteudo mudou
+    if current['size'] != cached['size']:
+        return False
+    current = file_signature(path)
+    if current['sha256'] != cached['sha256']:
+        return False
+    meta['source'] = current
+    return 'touched'
+
+def _write_meta(cache_dir, meta):
+    # grava em um arquivo temporario e renomeia, para um load concorrente nunca ler o json pela metade
+    tmp = os.path.join(cache_dir, f'meta.json.{os.getpid()}.tmp')
+    with open(tmp, 'w', encoding='utf-8') as file:
+        json.dump(meta, file, ensure_ascii=False)
+    os.replace(tmp, os.path.join(cache_dir, 'meta.json'))
+
+def write_cache(frame, cache_dir, source):
+    '''
+    Grava um DataFrame com a coluna 'dates' e colunas numéricas como values.npy, dates.npy e meta.json
+    '''
+    os.makedirs(cache_dir, exist_ok=True)
+    values = frame.drop(columns='dates').to_numpy(dtype=np.float64)
+    np.save(os.path.join(cache_dir, 'values.npy'), np.ascontiguousarray(values))
+    np.save(os.path.join(cache_dir, 'dates.npy'), frame['dates'].to_numpy(dtype='datetime64[ns]'))
+    meta = {
+        'version': CACHE_VERSION,
+        'source': source,
+        'columns': frame.columns.drop('dates').tolist(),
+        'columns_name': frame.columns.name,
+        'index': frame.index.tolist(),
+    }
+    # o meta.json e escrito por ultimo, entao um cache incompleto nunca e considerado valido
+    _write_meta(cache_dir, meta)
+
+def read_cache(cache_dir, meta):
+    '''
+    Monta o DataFrame a partir do cache; os valores ficam em um memmap somente leitura
+    '''
+    values = np.load(os.path.join(cache_dir, 'values.npy'), mmap_mode='r')
+    dates = np.load(os.path.join(cache_dir, 'dates.npy'))
+    columns = pd.Index(meta['columns'], name=meta['columns_name'])
+    frame = pd.DataFrame(values, index=pd.Index(meta['index']), columns=columns, copy=False)
+    frame.insert(0, 'dates', dates)
+    return frame
+
+def _load(path, cache_dir, read, normalize, refresh):
+    meta_path = os.path.join(cache_dir, 'meta.json')
+    if not refresh and os.path.exists(meta_path):
+        with open(meta_path, encoding='utf-8') as file:
+            meta = json.load(file)
+        status = _cache_is_valid(meta, path)
+        if status == 'touched': _write_meta(cache_dir, meta)
+        if status:
+            return read_cache(cache_dir, meta)
+    write_cache(normalize(read(path)), cache_dir, file_signature(path))
+    # devolve sempre o que esta no cache, para a primeira execucao ter os mesmos tipos das demais
+    with open(meta_path, encoding='utf-8') as file:
+        return read_cache(cache_dir, json.load(file))
+
+def load_stocks(path=None, cache_dir=None, refresh=False):
+    '''
+    Retornos mensais da Economatica normalizados, do cache quando ele ainda vale.
+
+    Parameters
+    ----------
+    path: str
+        Planilha de origem, data/raw/economatica_b3.xlsx se None
+    cache_dir: str
+        Pasta do cache, data/cache/stocks se None
+    refresh: bool
+        Ignora o cache e relê a planilha
+
+    Return
+    ------
+    stocks: dataframe pandas
+        Coluna 'dates' seguida de uma coluna float64 por ticker
+    '''
+    path = path or os.path.join(RAW_DIR, STOCKS_FILE)
+    cache_dir = cache_dir or os.path.join(CACHE_DIR, 'stocks')
+    return _load(path, cache_dir, pd.read_excel, normalize_stocks, refresh)
+
+def load_composition(path=None, cache_dir=None, refresh=False):
+    '''
+    Composição do IBRx normalizada, do cache quando ele ainda vale.
+
+    Parameters
+    ----------
+    path: str
+        Planilha de origem, data/raw/composicao_IBRx.xlsx se None
+    cache_dir: str
+        Pasta do cache, data/cache/composition se None
+    refresh: bool
+        Ignora o cache e relê a planilha
+
+    Return
+    ------
+    composition: dataframe pandas
+        Coluna 'dates' seguida de uma coluna float64 por ticker
+    '''
+    path = path or os.path.join(RAW_DIR, COMPOSITION_FILE)
+    cache_dir = cache_dir or os.path.join(CACHE_DIR, 'composition')
+    return _load(path, cache_dir, pd.read_excel, normalize_composition, refresh)
@@ -8,6 +8,8 @@ import scipy.cluster.hierarchy as hr
 from scipy.cluster.hierarchy import dendrogram, fcluster
 from matplotlib import pyplot as plt
 from scipy.spatial.distance import pdist, squareform
+import pipeline
+import profiling
 
 class Tree:
   '''
@@ -22,12 +24,100 @@ class Tree:
   weight: float
           É o peso que será atribuido a cada cluster ou ativo
   '''
+  __slots__ = ('left', 'right', 'data', 'weight')
+
   def __init__(self, value, weight = None) -> None:
       self.left = None
       self.right = None
       self.data = value
       self.weight = weight
 
+class ArrayTree:
+  '''
+  Árvore do dendrogram guardada em arrays paralelos, sem um objeto por nó.
+
+  O nó interno k (índice len_asset + k no linkage) tem filhos left[k] e right[k]; as folhas são
+  os ativos 0, ..., len_asset - 1. Como cada nó divide o peso do pai igualmente entre os dois
+  filhos, o peso de uma folha é weight * 2 ** -depth, onde depth é a profundidade da folha.
+
+  A profundidade e a posição de cada folha na ordem da esquerda para a direita são somas ao
+  longo do caminho até a raiz (1 por aresta e, para um filho da direita, o tamanho do irmão da
+  esquerda). As duas saem juntas de um pointer jumping sobre o vetor de pais: cada passada
+  vetorizada dobra o alcance de todos os nós, então são log2(altura) passadas e nenhum laço
+  por nó.
+
+  Parameters
+  ---------------
+  left: ndarray
+          Filho da esquerda de cada nó interno
+  right: ndarray
+          Filho da direita de cada nó interno
+  count: ndarray
+          Quantidade de folhas de cada nó interno (coluna 3 do linkage)
+  weight: float
+          Peso da raiz
+  '''
+  __slots__ = ('left', 'right', 'count', 'weight', 'len_asset', '_paths')
+
+  def __init__(self, left, right, count, weight = 100) -> None:
+      self.left = np.asarray(left, dtype=int)
+      self.right = np.asarray(right, dtype=int)
+      self.count = np.asarray(count, dtype=int)
+      self.weight = weight
+      self.len_asset = len(self.left) + 1
+      self._paths = None
+
+  @classmethod
+  def from_linkage(cls, clustering, weight = 100):
+      '''
+      Cria a árvore direto das colunas 0, 1 e 3 da matriz de linkage
+      '''
+      return cls(clustering[:, 0], clustering[:, 1], clustering[:, 3], weight)
+
+  def paths(self):
+      '''
+      Profundidade e posição (quantidade de folhas à esquerda) de cada nó, folhas e nós
+      internos, calculadas uma única vez
+      '''
+      if self._paths is not None: return self._paths
+      n = self.len_asset
+      root = 2 * n - 2
+      parent = np.full(2 * n - 1, root)
+      parent[self.left] = parent[self.right] = np.arange(n, 2 * n - 1)
+      size = np.concatenate((np.ones(n, dtype=int), self.count))
+      # valor da aresta de cada nó até o pai: (1, tamanho do irmão da esquerda ou 0); raiz (0, 0)
+      path = np.zeros((2, 2 * n - 1), dtype=int)
+      path[0] = 1
+      path[0, root] = 0
+      path[1, self.right] = size[self.left]
+      # invariante: path[:, v] soma as arestas de v até jump[v], exclusive
+      jump = parent
+      while (jump != root).any():
+        path = path + path[:, jump]
+        jump = jump[jump]
+      self._paths = (path[0], path[1])
+      return self._paths
+
+  def depth(self):
+      '''
+      Profundidade de cada nó (folhas e nós internos), a raiz tem profundidade 0
+      '''
+      return self.paths()[0]
+
+  def leaves(self):
+      '''
+      Ordem das folhas da esquerda para a direita, a mesma do hr.leaves_list
+      '''
+      order = np.empty(self.len_asset, dtype=int)
+      order[self.paths()[1][:self.len_asset]] = np.arange(self.len_asset)
+      return order
+
+  def leaf_weights(self):
+      '''
+      Peso de cada folha na ordem de leaves(): weight * 2 ** -depth
+      '''
+      return np.ldexp(float(self.weight), -self.depth()[self.leaves()])
+
 def get_stocks(asset, s_date, e_date):
   '''
     Essa função como o próprio nome já diz tem como objetivo pegar os dados dos ativos que iremos usar
@@ -90,16 +180,26 @@ def calc_distance(correlation):
   distance = np.sqrt(0.5 * (1 - correlation))
   return distance
 
-def euclidean_distance_improve(len_stocks, distance_df):
-  eucli_dist = pd.DataFrame()
-  for n in range(len_stocks):
-    for k in range(( distance_df.shape[0] * distance_df.shape[1] )):
-      row = int(np.floor(k / distance_df.shape[1]))
-      col = k % distance_df.shape[1]
-      eucli_dist.loc[row, col] = np.sqrt((distance_df.iloc[n, row] - distance_df.iloc[n, col]) ** 2)
-  eucli_dist.index = distance_df.index
-  eucli_dist.columns = distance_df.columns
-  return eucli_dist
+def euclidean_distance_improve(len_stocks, distance_df, chunk_size=None):
+  '''
+  Distancia entre as colunas da matriz de distancia inspirada no artigo do DiVA, com a
+  saida dos lacos originais; a implementacao vetorizada fica em pipeline.column_distance.
+
+  Parameters
+  ------------
+  len_stocks: int
+      Quantidade de linhas da matriz de distancia percorridas (a ultima define o resultado)
+  distance_df: dataframe pandas
+      Matriz de distancia de Mantegna
+  chunk_size: int
+      Quantidade de linhas do resultado escritas por bloco
+
+  Return
+  ------------
+  eucli_dist: dataframe pandas
+      Matriz com as distancias entre as colunas
+  '''
+  return pipeline.column_distance(distance_df, len_stocks, chunk_size)
 
 def hierarchical_clustering(euclidean_distance, linkage):
   '''
@@ -201,20 +301,24 @@ def create_tree_from_clusters(cluster, dicio, raiz, len_asset):
       Lista contendo dois elementos ou apenas um, esses elementos são os indices dos clusters que
       foram combinados na criação do ultimo cluster
   '''
-  for i, subcluster in enumerate(cluster):
-    if subcluster < len_asset:
-      if i == 0:
-          raiz.left = Tree(subcluster)
-      else:
-          raiz.right = Tree(subcluster)
-    else:
-      next_cluster = dicio[subcluster]
-      node = Tree(subcluster)
-      if i == 0:
-          raiz.left = node
+  #pilha explicita no lugar da recursao, dendrogramas em cadeia passam do limite de recursao
+  stack = [(cluster, raiz)]
+  while stack:
+    cluster, raiz = stack.pop()
+    for i, subcluster in enumerate(cluster):
+      if subcluster < len_asset:
+        if i == 0:
+            raiz.left = Tree(subcluster)
+        else:
+            raiz.right = Tree(subcluster)
       else:
-          raiz.right = node
-      create_tree_from_clusters(next_cluster, dicio, node, len_asset)
+        next_cluster = dicio[subcluster]
+        node = Tree(subcluster)
+        if i == 0:
+            raiz.left = node
+        else:
+            raiz.right = node
+        stack.append((next_cluster, node))
 
 def weight_tree(arvore):
   '''
@@ -223,14 +327,16 @@ def weight_tree(arvore):
 
   Parameters
   ----------
-  arvore : Tree
-      Raiz da arvore
+  arvore : Tree ou ArrayTree
+      Raiz da arvore; com uma ArrayTree os pesos saem de uma unica passada vetorizada
 
   Return
   --------------
   vet_weight : list
       vetor contendo o peso de cada folha da arvore
   '''
+  if isinstance(arvore, ArrayTree):
+    return arvore.leaf_weights().tolist()
   if not arvore:
     return []
 
@@ -255,17 +361,19 @@ def weight_tree(arvore):
 
   return vet_weight
 
-def main(data, asset):
+def main(data, asset=None, metric='euclidean'):
   #asset = ['MSFT', 'PCAR', 'JPM', 'AAPL', 'GOOGL', 'AMZN', 'ITUB', 'VALE', 'SHEL', 'INTC']
   #start = '2016-01-01'; end = '2022-01-01'
   #data_stocks = get_stocks(asset, start,  end)
 
   # Stage 1: Hierarchical Clustering
 
-  correlation = get_correlation(data)
-  distance = calc_distance(correlation)
-  distance_euclidean = (pdist(distance, metric='euclidean'))
-  clustering = hierarchical_clustering(distance_euclidean, 'ward')
+  # data pode ser o DataFrame de retornos ou um pipeline.WindowContext ja calculado;
+  # metric e uma de pipeline.DISTANCE_METRICS (o pdist, 'euclidean')
+  context = pipeline.as_context(data, metric)
+  if asset is None: asset = list(context.assets)
+  #linkage 'ward' sobre context.condensed, calculada uma unica vez por contexto
+  clustering = context.linkage('ward')
   
   # Etapa 2: Determinação dos clusters
   # Define o número de clusters desejado (exemplo: 2 clusters)
@@ -275,30 +383,19 @@ def main(data, asset):
 
   # Additional Stage to aux the weight stage
 
-  #dicionario contendo os indices dos clusters gerados da combinação de outros 2
-  cluster_merged = get_idx_cluster_merged(clustering, len(asset))
-    
-  #lista contendo as chaves do dicionario
-  keys = list(cluster_merged.keys())
-  
-  #ultimos clusters merged
-  cluster = cluster_merged[keys[-1]]
-  
-  #Cria arvore onde a raiz é os dois ultimos clusters combinados
-  raiz = Tree(cluster, 100)
-  
-  #criando a arvore atravez dos dois ultimos clusters combinados
-  #usando o dicionario para mapear os clusters que foram criados atraves da combinação
-  #passando a arvore para prencher o campo data de cada no
-  create_tree_from_clusters(cluster, cluster_merged, raiz, len(asset))
+  #Cria a arvore em arrays paralelos direto da matriz de linkage, a raiz é o ultimo cluster
+  #combinado e recebe peso 100 (Tree + create_tree_from_clusters dão o mesmo resultado)
+  with profiling.stage('hcaa.tree'):
+    raiz = ArrayTree.from_linkage(clustering, 100)
   
   #Stage 2: Assigning weights to clusters
   
   #vetor com o peso de cada ativo e cluster
-  vet_weight = weight_tree(raiz)
+  with profiling.stage('hcaa.weights'):
+    vet_weight = weight_tree(raiz)
   
   #dicionario mapeando o ativo e seu respectivo peso no portfolio
-  dict_asset_weight = {key: f'{value}%' for key, value in zip(list(hr.leaves_list(clustering)), vet_weight)}
+  dict_asset_weight = {key: f'{value}%' for key, value in zip(raiz.leaves().tolist(), vet_weight)}
  
   #Print of dendrogram
   #print(vet_weight)
@@ -5,6 +5,8 @@ from scipy.spatial.distance import pdist, squareform
 import scipy.cluster.hierarchy as hr
 from scipy.cluster.hierarchy import dendrogram
 from scipy.optimize import minimize
+import pipeline
+import profiling
 
 def get_correlation(data):
     return data.corr(method='pearson')
@@ -24,34 +26,37 @@ def hierarchical_clustering(euclidean_distance, linkage):
 
 # algoritmo para obter a matriz de similariadade, atraves das alturas dos clusters
 def construir_matriz_similaridade(clustering_matrix, assets):
+    '''
+    Matriz n x n com a altura em que cada par de ativos foi unido no dendrogram (a distância
+    ultramétrica, a mesma do hr.cophenet), com a diagonal zerada.
+
+    Na ordem das folhas do dendrogram todo cluster ocupa um intervalo contíguo, e a união do
+    cluster [a, m) com [m, b) preenche exatamente os blocos [a, m) x [m, b) e [m, b) x [a, m).
+    Cada bloco é escrito de uma vez com np.ix_ direto na matriz final, sem a matriz
+    (2n-1) x (2n-1) e sem as listas de membros de cada cluster.
+    '''
     num_assets = len(assets)
-    num_clusters = num_assets + len(clustering_matrix)
-    
-    # Inicializando a matriz de similaridade
-    matriz_similaridade = np.zeros((num_clusters, num_clusters))
-
-    # Mapeamento de clusters já formados
-    cluster_map = {i: [i] for i in range(num_assets)}
-    
-    # Preenchendo a matriz de similaridade a partir da matriz de clusterização
+    clustering_matrix = np.asarray(clustering_matrix)
+    order = hr.leaves_list(clustering_matrix)
+
+    # intervalo [inicio, fim) de cada folha e de cada cluster na ordem das folhas
+    inicio = np.empty(num_assets + len(clustering_matrix), dtype=int)
+    fim = np.empty_like(inicio)
+    inicio[order] = np.arange(num_assets)
+    fim[order] = inicio[order] + 1
+
+    matriz_similaridade = np.zeros((num_assets, num_assets))
     for i, (cluster1, cluster2, altura, _) in enumerate(clustering_matrix):
         cluster1, cluster2 = int(cluster1), int(cluster2)
-        new_cluster = num_assets + i
-        
-        # Atualizando o mapa com o novo cluster formado
-        cluster_map[new_cluster] = cluster_map[cluster1] + cluster_map[cluster2]
-        
-        # Atualizando a matriz de similaridade para todos os elementos dos clusters fundidos
-        for elem1 in cluster_map[cluster1]:
-            for elem2 in cluster_map[cluster2]:
-                matriz_similaridade[elem1, elem2] = altura
-                matriz_similaridade[elem2, elem1] = altura
-
-    # Extraindo a submatriz correspondente apenas aos ativos originais
-    final_matriz = matriz_similaridade[:num_assets, :num_assets]
+        membros1 = order[inicio[cluster1]:fim[cluster1]]
+        membros2 = order[inicio[cluster2]:fim[cluster2]]
+        matriz_similaridade[np.ix_(membros1, membros2)] = altura
+        matriz_similaridade[np.ix_(membros2, membros1)] = altura
+        inicio[num_assets + i] = inicio[cluster1]
+        fim[num_assets + i] = fim[cluster2]
 
     # Convertendo para DataFrame para melhor visualização
-    matriz_df = pd.DataFrame(final_matriz, columns=assets, index=assets)
+    matriz_df = pd.DataFrame(matriz_similaridade, columns=assets, index=assets)
     return matriz_df
 
 # função que transforma a matriz d_barra na matriz s_barra
@@ -66,58 +71,151 @@ def f(d_barra):
     f_barra = (1 - ((d_barra ** 2) / 0.5)) / N
     return f_barra 
 
-# algortimo que minimiza a função 19, porém como conversado na ultima reunião
-# ao inves de maximizar deve ser performada a minimização sem levar em consideração
-# o retorno esperado
-def resolver_otimizacao(S_bar_df, gammas):
-    S_bar = S_bar_df.values
-    n = S_bar.shape[0]
-    resultados = {}
+# gamma efetivo de cada problema; hoje todos os gammas resolvem o mesmo problema com gamma = 1
+def gamma_efetivo(gamma):
+    return 1.0 #if gamma == np.inf else gamma
 
+# objetivo -gamma * b' S b com o gradiente analitico -2 * gamma * S b (S simetrica)
+def objetivo_qp(b, S_bar, gamma_val):
+    Sb = S_bar @ b
+    return - (gamma_val * b @ Sb), -2 * gamma_val * Sb
+
+def resolver_qp(S_bar, gamma_val, b0=None):
+    '''
+    Resolve min -gamma * b' S b sujeito a sum(b) = 100 e 0 <= b <= 100 com o SLSQP e o
+    gradiente analitico.
+
+    O objetivo e concavo (S tem diagonal positiva), entao o problema tem varios minimos locais
+    e o resultado depende do metodo: o trust-constr com a Hessiana chega a outro ponto (objetivo
+    perto de 200 contra 145 do SLSQP com n = 50) e por isso nao e oferecido.
+
+    Parameters
+    ----------
+    S_bar: ndarray
+        Matriz s_barra (n x n)
+    gamma_val: float
+        Gamma efetivo do problema
+    b0: ndarray
+        Ponto inicial, os budgets da janela anterior (warm start); 100 / n em cada ativo se None
+
+    Return
+    ------
+    b: ndarray
+        Budgets (somam 100)
+    '''
+    n = S_bar.shape[0]
+    b0 = _start_budgets(b0, n)  # chute inicial, uniforme se b0 for None ou nulo
     # Restrições
-    restricoes = {'type': 'eq', 'fun': lambda b: np.sum(b) - 100}
+    restricoes = {'type': 'eq', 'fun': lambda b: np.sum(b) - 100, 'jac': lambda b: np.ones_like(b)}
     limites = [(0, 100) for _ in range(n)]
-    b0 = np.ones(n) * (100 / n)  # chute inicial
+    res = minimize(objetivo_qp, b0, args=(S_bar, gamma_val), method='SLSQP', jac=True,
+                   bounds=limites, constraints=[restricoes])
+    profiling.count('hrb.optimization', nit=res.nit, nfev=res.nfev)
+    return res.x
 
+# algortimo que minimiza a função 19, porém como conversado na ultima reunião
+# ao inves de maximizar deve ser performada a minimização sem levar em consideração
+# o retorno esperado
+def resolver_otimizacao(S_bar_df, gammas, b0=None, batched=False):
+    '''
+    Budgets b de cada gamma. Gammas com o mesmo gamma efetivo compartilham uma única otimização.
+
+    Parameters
+    ----------
+    S_bar_df: dataframe pandas ou ndarray
+        Matriz s_barra
+    gammas: list
+        Gammas pedidos
+    b0: ndarray
+        Ponto inicial de todos os problemas (warm start), 100 / n em cada ativo se None
+    batched: bool
+        Retorna um ndarray gammas x ativos em vez do dicionario
+
+    Return
+    ------
+    resultados: dict ou ndarray
+        {gamma: b} ou a matriz com um b por linha, na ordem de gammas
+    '''
+    S_bar = np.asarray(S_bar_df, dtype=float)
+    resolvidos = {}
     for gamma in gammas:
-        gamma_val = 1.0 #if gamma == np.inf else gamma
-        def objetivo(b):
-            return - (gamma_val * b.T @ S_bar @ b) 
-
-        res = minimize(objetivo, b0, method='SLSQP', bounds=limites, constraints=[restricoes])
-
-        resultados[gamma] = res.x
-
-    return resultados
+        gamma_val = gamma_efetivo(gamma)
+        if gamma_val not in resolvidos:
+            resolvidos[gamma_val] = resolver_qp(S_bar, gamma_val, b0)
+
+    if batched:
+        return np.array([resolvidos[gamma_efetivo(gamma)] for gamma in gammas])
+    return {gamma: resolvidos[gamma_efetivo(gamma)].copy() for gamma in gammas}
+
+# abaixo disso os budgets alinhados sao tratados como nulos (so restos numericos do SLSQP)
+BUDGET_FLOOR = 1e-6
+
+def _start_budgets(b0, n):
+    # ponto inicial somando 100; sem budget relevante volta para o chute uniforme
+    if b0 is None: return np.ones(n) * (100 / n)
+    b0 = np.clip(np.asarray(b0, dtype=float), 0, 100)
+    total = b0.sum()
+    if not np.isfinite(total) or total < BUDGET_FLOOR: return np.ones(n) * (100 / n)
+    return b0 * (100 / total)
+
+# alinha os budgets da janela anterior aos ativos atuais para servir de ponto inicial;
+# ativos novos recebem 100 / n e o vetor e reescalado para somar 100. Se os ativos com budget
+# sairam do universo (e nenhum entrou) nao ha o que aproveitar e o chute uniforme e usado
+def warm_start_budgets(previous, assets):
+    if previous is None: return None
+    b0 = pd.Series(previous, dtype=float).reindex(assets).fillna(100 / len(assets)).to_numpy()
+    return _start_budgets(b0, len(assets))
 
 # função que performa a equeção 17
 def get_w_subi(b, data):
-    w_i = []
-    for i, j in enumerate(b):
-        w_i.append(b[j] / data.std().values)
-    return w_i
+    # data pode ser o DataFrame de retornos ou um pipeline.WindowContext, que ja traz o desvio padrao
+    volatility = data.volatility if isinstance(data, pipeline.WindowContext) else data.std().values
+    return np.array(list(b.values())) / volatility
 
 # função que performa a equação 18
 def get_w_i_hrb(w_i):
-    w_i_hrb = []
-    for i, j in enumerate(w_i):
-        w_i_hrb.append(w_i[i] / np.sum(w_i[i]))
-    return w_i_hrb
-
-def main(data, assets):
-    correlation = get_correlation(data)                                     # Processo para obter matriz D
-    distance_corr = calc_distance(correlation)                              # Processo para obter matriz D
-    e_distance = euclidean_distance(distance_corr)                          # Aqui obtemos a matriz D
-    clustering = hierarchical_clustering(e_distance, 'single')              # Aqui obtemos a matriz clustering para obter a matriz D_barra
-    matriz_similaridade = construir_matriz_similaridade(clustering, assets) # Aqui obtemos a matriz D_barra
+    w_i = np.asarray(w_i)
+    return w_i / w_i.sum(axis=-1, keepdims=True)
+
+def budgets_to_weights(budgets, volatility):
+    '''
+    Equações 17 e 18 de uma vez: w = (b / sigma) / soma(b / sigma), para cada linha de budgets.
+
+    Parameters
+    ----------
+    budgets: ndarray
+        Budgets, gammas x ativos (ou um único vetor de ativos)
+    volatility: ndarray
+        Desvio padrão de cada ativo, calculado uma única vez por janela
+
+    Return
+    ------
+    w: ndarray
+        Pesos normalizados com o mesmo formato de budgets
+    '''
+    w_i = np.asarray(budgets, dtype=float) / np.asarray(volatility, dtype=float)
+    return w_i / w_i.sum(axis=-1, keepdims=True)
+
+def main(data, assets=None, metric='euclidean', previous_budgets=None, return_state=False, gamma=10):
+    '''
+    Pesos do HRB. Com um gamma escalar retorna o vetor de pesos; com uma lista de gammas
+    (ex.: [10, 20, 40, 80, np.inf], como o autor) retorna uma matriz gammas x ativos.
+    '''
+    context = pipeline.as_context(data, metric)                             # Retornos crus ou WindowContext ja calculado
+    if assets is None: assets = list(context.assets)
+    # a matriz D_barra so depende das alturas das unioes, nao da ordem das folhas, entao o
+    # optimal_ordering (O(n³)) nao muda o resultado e fica desligado
+    clustering = context.linkage('single', optimal_ordering=False)          # Linkage sobre a matriz D para obter a matriz D_barra
+    with profiling.stage('hrb.similarity'):
+        matriz_similaridade = construir_matriz_similaridade(clustering, assets) # Aqui obtemos a matriz D_barra
 
     s_barra = f(matriz_similaridade)                # Obtendo a matriz s_barra
-    #gamma = [10, 20, 40, 80, np.inf]               # Definindo gamma como o autor
-    gamma = [10]
-    b = resolver_otimizacao(s_barra, gamma)         # Obtendo os valores de b após performar a minimização da equação 19
-    w_i = get_w_subi(b, data)                       # Obtendo os valores de w_i após resolver equação 17
-    w_i_hrb = get_w_i_hrb(w_i)                      # Obtendo os valores de w_i_hrb (budgets) após resolver equação 18
-
-    budgets_portfolio = pd.DataFrame((w_i_hrb[i] for i in range(len(w_i_hrb))), index=gamma, columns=assets).T
-    #budgets_portfolio.loc['soma'] = budgets_portfolio.sum()
-    return budgets_portfolio[10].values
\ No newline at end of file
+    gammas = np.atleast_1d(gamma).tolist()
+    b0 = warm_start_budgets(previous_budgets, assets)  # budgets da janela anterior por ticker (warm start)
+    with profiling.stage('hrb.optimization'):
+        b = resolver_otimizacao(s_barra, gammas, b0, batched=True)  # Obtendo os valores de b (gammas x ativos) da equação 19
+    w_hrb = budgets_to_weights(b, context.volatility)           # Equações 17 e 18 em um único broadcast
+
+    if np.ndim(gamma) == 0: w_hrb = w_hrb[0]
+    if return_state: return w_hrb, pd.Series(b[0], index=assets)
+    return w_hrb
\ No newline at end of file
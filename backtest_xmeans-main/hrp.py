@@ -3,6 +3,9 @@ import pandas as pd
 import numpy as np
 import scipy.cluster.hierarchy as hr
 from scipy.spatial.distance import pdist, squareform
+import pipeline
+import profiling
+from cache import LRUCache, array_key
 import warnings
 warnings.filterwarnings("ignore", category=FutureWarning)
 
@@ -68,7 +71,7 @@ def calc_distance(correlation):
   distance = np.sqrt(0.5 * (1 - correlation))
   return distance
 
-def euclidian_distance_improve(len_stocks, distance):
+def euclidian_distance_improve(len_stocks, distance, chunk_size=None):
   '''
   Função que tem como unico objetivo calcular e retornar a distancia
   euclidiana que sera usada para fazer a etapa de "Quasi-Diagonalisatio"
@@ -85,19 +88,15 @@ def euclidian_distance_improve(len_stocks, distance):
     é a matriz de correlação distancia
   len_stocks
     tamanho do vetor de tickers ("ações") que tiveram dados baixados
+  chunk_size
+    quantidade de linhas do resultado escritas por vez
 
   Return
   -------
   eucli_dist
     é a matriz com todas as distancias euclidianas calculadas
   '''
-  eucli_dist = pd.DataFrame(index=distance.index, columns=distance.columns)
-  for n in range(len_stocks): #algoritmo quadratico
-    for k in range(( distance.shape[0] * distance.shape[1] )):
-      row = int(np.floor(k / distance.shape[1]))
-      col = k % distance.shape[1]
-      eucli_dist.iloc[row][col] = np.sqrt((distance.iloc[n][row] - distance.iloc[n][col])**2)
-  return eucli_dist
+  return pipeline.column_distance(distance, len_stocks, chunk_size)
 
 def hierarchical_clustering(euclidean_distance, linkage):
   '''
@@ -148,25 +147,56 @@ Funcao retirada diretamente do site do Lopéz de Prado onde tem o codigo do HRP
 disponivel
 '''
 def recursive_bisection(covariance_matrix, sortIx):
-  #create a column vector w with indices equal to sortIx and all values equal to 1
-  w = pd.Series(1, index=sortIx)
-  #create a list cItems containing one element, which corresponds to the list sortIx
-  cItems = [sortIx]
+  #pesos calculados sobre posicoes inteiras da matriz de covariancia ja permutada
+  positions = covariance_matrix.index.get_indexer(sortIx)
+  cov = np.asarray(covariance_matrix, dtype=float)[np.ix_(positions, positions)]
+  #retorna o vetor de peso para o portfolio
+  return pd.Series(recursive_bisection_weights(cov), index=sortIx)
+
+def recursive_bisection_weights(sorted_cov):
+  '''
+  Recursive bisection do López de Prado somente com NumPy, sobre posições inteiras.
+
+  Os clusters são sempre intervalos contíguos [a, b) da ordem quasi-diagonal, então a
+  variância do portfólio de variância inversa de um cluster,
+
+    cVar(a, b) = u' C u / (soma de 1/diag(C) em [a, b)) ** 2,  u = 1/diag(C) em [a, b),
+
+  sai de duas estruturas de prefixo calculadas uma única vez: a soma acumulada de
+  1/diag(C) e a tabela de somas acumuladas 2D de C * u u', o que torna cada cVar O(1).
+
+  Parameters
+  ----------
+  sorted_cov
+    matriz de covariância (ndarray) já permutada na ordem quasi-diagonal
+
+  Return
+  ------
+  w
+    pesos na mesma ordem de sorted_cov
+  '''
+  n = sorted_cov.shape[0]
+  inv_var = 1. / np.diag(sorted_cov)
+  prefix_inv = np.concatenate(([0.], np.cumsum(inv_var)))
+  table = np.zeros((n + 1, n + 1))
+  table[1:, 1:] = (sorted_cov * np.outer(inv_var, inv_var)).cumsum(axis=0).cumsum(axis=1)
+
+  def cluster_var(a, b):
+    num = table[b, b] - table[a, b] - table[b, a] + table[a, a]
+    return num / (prefix_inv[b] - prefix_inv[a]) ** 2
+
+  w = np.ones(n)
+  cItems = [(0, n)]
   while len(cItems) > 0:
-    #divide o vetor cItems em 2 tendo como ponto de  divisao o meio do vetor
-    cItems=[ i[j: k] for i in cItems for j, k in ( (0, len(i) // 2), (len(i) // 2, len(i)) ) if len(i) > 1 ]
+    #divide cada intervalo em 2 tendo como ponto de divisao o meio do intervalo
+    cItems = [ part for a, b in cItems if b - a > 1 for part in ( (a, a + (b - a) // 2), (a + (b - a) // 2, b) ) ]
     for i in range(0, len(cItems), 2):
-      cItems0 = cItems[i]   # cluster 1
-      cItems1 = cItems[i+1] # cluster 2
-      #calcula a variança e variança inversa do cluster fonecido por parametro
-      cVar0 = getClusterVar(covariance_matrix, cItems0)
-      cVar1 = getClusterVar(covariance_matrix, cItems1)
-      #calcula o alfa para ser calculado o peso
+      (a0, b0), (a1, b1) = cItems[i], cItems[i+1]
+      cVar0 = cluster_var(a0, b0)
+      cVar1 = cluster_var(a1, b1)
       alpha = 1 - cVar0 / (cVar0+cVar1)
-      #atualiza o peso
-      w[cItems0] *= float(alpha) # weight 1
-      w[cItems1] *= float(1-alpha) # weight 2
-  #retorna o vetor de peso para o portfolio
+      w[a0:b0] *= alpha # weight 1
+      w[a1:b1] *= 1-alpha # weight 2
   return w
 
 '''
@@ -210,6 +240,53 @@ def getQuasiDiag(link):
         sortIx.index = range(sortIx.shape[0]) # re-index
     return sortIx.tolist()
 
+# ordens quasi-diagonais ja calculadas, indexadas pelo conteudo da linkage matrix
+_quasi_diag_cache = LRUCache(maxsize=512)
+
+def quasi_diag_order(link):
+  '''
+  Mesma ordem das folhas de getQuasiDiag em tempo linear, sem pandas e sem recursão.
+
+  Em getQuasiDiag o np.append descarta o índice dos filhos da direita, então a cada nível cada
+  posição que ainda guarda um cluster é trocada pelo filho da esquerda e o filho da direita vai
+  para o final da sequência (não é a ordem em profundidade do hr.leaves_list). Uma posição nunca
+  muda de lugar, então basta percorrer a linkage matrix com uma lista de trabalho das posições que
+  ainda guardam clusters, visitando cada nó interno uma única vez.
+
+  O resultado fica em cache por conteúdo da linkage matrix.
+
+  Parameters
+  ----------
+  link
+    linkage matrix do scipy
+
+  Return
+  ------
+  order
+    array de inteiros (somente leitura) com a posição dos ativos na ordem quasi-diagonal
+  '''
+  key = array_key(link)
+  order = _quasi_diag_cache.get(key)
+  if order is not None:
+    return order
+  children = np.asarray(link)[:, :2].astype(int).tolist()
+  numItems = len(children) + 1 # number of original items
+  order = [2 * numItems - 2] # raiz
+  pending = [0] # posicoes de order que ainda guardam clusters, em ordem crescente
+  while pending:
+    kept, added = [], []
+    for pos in pending:
+      left, right = children[order[pos] - numItems]
+      order[pos] = left # item 1
+      if left >= numItems: kept.append(pos)
+      order.append(right) # item 2, no final da sequencia
+      if right >= numItems: added.append(len(order) - 1)
+    #as posicoes novas sao sempre maiores que as antigas, a lista continua ordenada
+    pending = kept + added
+  order = np.array(order, dtype=int)
+  order.setflags(write=False)
+  return _quasi_diag_cache.put(key, order)
+
 '''
 A forma de calcular o peso dos ativos usando recursive bisection tem um problema
 que é, a ordem dos ativos importam, portanto, caso ocorra uma alteração na ordem
@@ -220,25 +297,29 @@ preservados mesmo que ocorra alteração na ordem dos mesmo, são eles 'bottom-u
 'top-down'.
 '''
 
-def main(data):
+def main(data, metric='euclidean'):
   #Para ações brasileiras, usar: TICKER.SA
   #asset = ['MSFT', 'PCAR', 'JPM', 'AAPL', 'GOOGL', 'AMZN', 'ITUB', 'VALE', 'SHEL', 'INTC']
   #start = '2016-01-01'; end = '2022-01-01'
   #data_stocks = get_stocks(asset, start,  end)
   # Stage 1: Tree clustering
-  correlation = get_correlation(data)
-  distance = calc_distance(correlation)
-  distance_euclidian_square = ((pdist(distance, metric='euclidean')))
-  clustering = hierarchical_clustering(distance_euclidian_square, 'ward')
+  # data pode ser o DataFrame de retornos ou um pipeline.WindowContext ja calculado;
+  # metric e uma de pipeline.DISTANCE_METRICS (o pdist, 'euclidean')
+  context = pipeline.as_context(data, metric)
+  #linkage 'ward' sobre context.condensed, compartilhada com o HCAA quando o contexto e o mesmo
+  clustering = context.linkage('ward')
   # Stage 2: Quasi-Diagonalisation
-  sortIx = getQuasiDiag(clustering)
-  sorted_assets = [data.columns[i] for i in sortIx]
+  with profiling.stage('hrp.quasi_diag'):
+    sortIx = quasi_diag_order(clustering)
+  sorted_assets = [context.assets[i] for i in sortIx]
   #sortIx = hr.leaves_list(clustering).tolist()
   #sortIx = correlation.index[sortIx].tolist() # recover labels
 
-  # Stage 3: Recursive Bisection
-  rec_bisection = recursive_bisection(data.cov(), sorted_assets)
+  # Stage 3: Recursive Bisection (pesos na ordem quasi-diagonal de sorted_assets)
+  sorted_cov = context.covariance[np.ix_(sortIx, sortIx)]
+  with profiling.stage('hrp.recursive_bisection'):
+    rec_bisection = recursive_bisection_weights(sorted_cov)
   
   #plot_dendrogram_figure([10, 5], clustering, data_stocks)
   #plot_network(data_stocks)
-  return rec_bisection.values
\ No newline at end of file
+  return rec_bisection
\ No newline at end of file
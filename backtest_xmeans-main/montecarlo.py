@@ -0,0 +1,212 @@
+'''
+Estudo de robustez dos alocadores por reamostragem da matriz de covariância.
+
+Para cada janela do backtest são sorteadas M matrizes de covariância (bootstrap das linhas de
+retorno, opcionalmente encolhidas em direção à diagonal), todas de uma vez em um array
+M x n x n. Cada matriz vira um pipeline.WindowContext e todos os alocadores rodam sobre ela. A
+dispersão dos pesos e do retorno fora da amostra entre os sorteios mostra o quanto cada método
+depende do erro de estimação da covariância. As janelas são distribuídas entre processos pelo
+mesmo workers.run_blocks do WalkForwardEngine.
+'''
+import os
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+import allocators
+import backtest
+import pipeline
+import workers
+
+
+def bootstrap_covariances(returns, n_draws, rng, shrinkage=0.0):
+    '''
+    M matrizes de covariância amostral de reamostragens bootstrap das linhas de returns.
+
+    Parameters
+    ----------
+    returns: ndarray
+        Retornos da janela, T x n
+    n_draws: int
+        Quantidade de sorteios M
+    rng: np.random.RandomState
+        Gerador dos índices sorteados
+    shrinkage: float
+        Intensidade do encolhimento de cada matriz em direção à sua diagonal, em [0, 1]; com
+        bootstrap as linhas repetidas deixam a matriz singular quando T não é bem maior que n
+
+    Return
+    ------
+    covariances: ndarray
+        M x n x n
+    '''
+    returns = np.asarray(returns, dtype=float)
+    T = returns.shape[0]
+    samples = returns[rng.randint(T, size=(n_draws, T))]  # M x T x n
+    centered = samples - samples.mean(axis=1, keepdims=True)
+    covariances = np.einsum('mti,mtj->mij', centered, centered) / (T - 1)
+    if shrinkage:
+        variances = np.einsum('mii->mi', covariances).copy()
+        covariances *= 1 - shrinkage
+        diagonal = np.einsum('mii->mi', covariances)
+        diagonal += shrinkage * variances
+    return covariances
+
+def draw_window(retu_ins, i, names, n_draws, seed=0, shrinkage=0.0):
+    '''
+    Roda os alocadores sobre n_draws covariâncias sorteadas de uma janela.
+
+    Parameters
+    ----------
+    retu_ins: dataframe pandas
+        Retornos dentro da amostra dos ativos elegíveis
+    i: int
+        Índice da janela, usado na seed dos sorteios e dos alocadores
+    names: list
+        Alocadores registrados em allocators.REGISTRY
+    n_draws: int
+        Quantidade de sorteios
+    seed: int
+        Seed base do estudo; os sorteios da janela i usam seed + i
+    shrinkage: float
+        Ver bootstrap_covariances
+
+    Return
+    ------
+    weights: ndarray
+        métodos x sorteios x ativos
+    '''
+    rng = np.random.RandomState(seed + i)
+    covariances = bootstrap_covariances(retu_ins.to_numpy(dtype=float), n_draws, rng, shrinkage)
+    selected = allocators.get(names)
+    weights = np.empty((len(selected), n_draws, retu_ins.shape[1]))
+    for d in range(n_draws):
+        context = pipeline.WindowContext(retu_ins.columns, covariance=covariances[d])
+        w_draw, _ = allocators.run(context, selected, seed=i)
+        weights[:, d] = w_draw
+    return weights
+
+
+@dataclass
+class MonteCarloResult:
+    '''
+    Pesos e retornos fora da amostra de todos os sorteios.
+
+    Parameters
+    ----------
+    methods: list
+        Alocadores, na ordem da primeira dimensão dos arrays
+    weights: dict
+        Para cada janela, (tickers, array métodos x sorteios x ativos)
+    returns: ndarray
+        Retorno fora da amostra, janelas x métodos x sorteios
+    '''
+    methods: list
+    weights: dict
+    returns: np.ndarray
+
+    def summary(self):
+        '''
+        Dispersão por janela e método: média, desvio e quantis 5% e 95% do retorno fora da
+        amostra entre os sorteios, e o desvio padrão médio dos pesos dos ativos
+        '''
+        rows = []
+        for i, (_, w) in sorted(self.weights.items()):
+            for m, method in enumerate(self.methods):
+                r = self.returns[i, m]
+                rows.append({'window': i, 'method': method, 'ret_mean': np.mean(r), 'ret_std': np.std(r, ddof=1),
+                             'ret_p05': np.quantile(r, 0.05), 'ret_p95': np.quantile(r, 0.95),
+                             'weight_std': np.std(w[m], axis=0, ddof=1).mean()})
+        return pd.DataFrame(rows).set_index(['window', 'method'])
+
+    def dispersion(self):
+        '''
+        Média das colunas de summary() sobre as janelas, uma linha por método
+        '''
+        return self.summary().groupby(level='method', sort=False).mean()
+
+
+# Estado de cada processo do pool, como em backtest._worker
+_worker = {}
+
+def _setup_worker(stocks, InS, options):
+    _worker.update(stocks=stocks, InS=InS, **options)
+
+def _run_block(block):
+    stocks = _worker['stocks']; InS = _worker['InS']
+    block_results = []
+    for i, aux in block:
+        retu_ins = stocks.iloc[i:(InS - 1 + i)][aux]
+        r_oos = stocks.iloc[InS + i][aux].to_numpy(dtype=float)
+        weights = draw_window(retu_ins, i, _worker['methods'], _worker['n_draws'], _worker['seed'],
+                              _worker['shrinkage'])
+        # retorno fora da amostra de cada sorteio, como o Rport do backtest
+        block_results.append((i, aux, weights, weights @ r_oos))
+    return block_results
+
+
+class MonteCarloStudy:
+    '''
+    Reamostragem da covariância em todas as janelas do backtest.
+
+    Parameters
+    ----------
+    stocks: dataframe pandas
+        Retornos mensais com a coluna 'dates' seguida de uma coluna por ticker
+    composition: dataframe pandas
+        Composição do IBRx com a coluna 'dates' seguida de uma coluna por ticker
+    InS: int
+        Tamanho da janela dentro da amostra
+    n_draws: int
+        Sorteios por janela (o nmethods do notebook)
+    shrinkage: float
+        Encolhimento de cada covariância sorteada em direção à diagonal
+    methods: list
+        Alocadores registrados em allocators.REGISTRY, backtest.METHODS se None
+    seed: int
+        Seed base dos sorteios
+    max_workers: int
+        Quantidade de processos, os.cpu_count() se None; com 1 roda no próprio processo
+    chunksize: int
+        Janelas enviadas a um processo por vez
+    '''
+    def __init__(self, stocks, composition, InS=120, n_draws=10, shrinkage=0.0, methods=None, seed=0,
+                 max_workers=None, chunksize=4):
+        self.stocks = stocks
+        self.composition = composition
+        self.InS = InS
+        self.n_draws = n_draws
+        self.shrinkage = shrinkage
+        self.methods = [allocator.name for allocator in allocators.get(methods or backtest.METHODS)]
+        self.seed = seed
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.chunksize = max(int(chunksize), 1)
+
+    def _options(self):
+        return {'methods': self.methods, 'n_draws': self.n_draws, 'seed': self.seed, 'shrinkage': self.shrinkage}
+
+    def run(self, windows=None):
+        '''
+        Parameters
+        ----------
+        windows: list
+            Índices das janelas, todas se None
+
+        Return
+        ------
+        result: MonteCarloResult
+        '''
+        OoS = self.stocks.shape[0] - self.InS
+        eligibility = backtest.EligibilityIndex(self.stocks, self.composition, self.InS)
+        work = [(i, eligibility.assets(i)) for i in (range(OoS) if windows is None else windows)]
+        blocks = workers.split_blocks(work, self.chunksize)
+
+        returns = np.full((OoS, len(self.methods), self.n_draws), np.nan)
+        weights = {}
+        for block in workers.run_blocks(_run_block, blocks, self.max_workers, _setup_worker,
+                                        (self.stocks, self.InS, self._options())):
+            for i, aux, w, r in block:
+                weights[i] = (aux, w)
+                returns[i] = r
+        return MonteCarloResult(methods=self.methods, weights=weights, returns=returns)
@@ -0,0 +1,273 @@
+'''
+Etapa de pré-processamento compartilhada pelos quatro alocadores (X-Means, HCAA, HRP e HRB).
+
+Todos os alocadores partem da mesma cadeia correlação -> distância de Mantegna -> distância
+euclidiana condensada -> linkage, e alguns ainda usam a covariância. Aqui essa cadeia é guardada
+em um WindowContext, que calcula cada etapa sob demanda uma única vez por janela e pode ser
+passado para o main de cada alocador no lugar dos retornos.
+'''
+import numpy as np
+import pandas as pd
+from scipy.spatial.distance import pdist, squareform
+
+import profiling
+from cache import LinkageCache
+
+# linkages de todas as janelas (e de todos os contextos com a mesma distancia), ver configure_linkage_cache
+linkage_cache = LinkageCache()
+
+def configure_linkage_cache(maxsize=1024, path=None):
+    '''
+    Troca o cache de linkages usado por WindowContext.linkage
+
+    Parameters
+    ----------
+    maxsize: int
+        Quantidade de linkages mantidas em memória
+    path: str
+        Pasta para persistir as linkages em disco entre execuções; None mantém só em memória
+    '''
+    global linkage_cache
+    linkage_cache = LinkageCache(maxsize, path)
+    return linkage_cache
+
+# 'euclidean' e a distancia do pdist entre as linhas da matriz de Mantegna. A distancia dos
+# lacos originais de euclidian_distance_improve (column_distance) nao e oferecida: ela so usa a
+# ultima linha da matriz e muda com a ordem das colunas
+DISTANCE_METRICS = ('euclidean',)
+
+def _read_only(array):
+    array = np.array(array, dtype=float)
+    array.setflags(write=False)
+    return array
+
+
+class WindowContext:
+    '''
+    Pacote com tudo que os alocadores precisam de uma janela, calculado sob demanda.
+
+    Cada matriz só é calculada no primeiro acesso e depois fica guardada, então um alocador que
+    não usa a covariância (ou a distância) não paga por ela, e as que são usadas por vários
+    alocadores são calculadas uma única vez. Os arrays devolvidos são somente leitura.
+
+    Parameters
+    ----------
+    assets: tuple
+        Tickers da janela, na mesma ordem das linhas/colunas das matrizes
+    data: dataframe pandas
+        Retornos da janela, uma coluna por ativo; fonte da correlação, covariância e volatilidade
+    metric: str
+        Métrica usada para obter condensed, uma de DISTANCE_METRICS
+    precomputed:
+        Matrizes já calculadas (correlation, covariance, volatility, distance, condensed), usadas
+        no lugar de data; com somente a covariância, a correlação e a volatilidade saem dela.
+        Sem data, pedir uma matriz que não foi informada nem sai das informadas (por exemplo a
+        covariância com somente correlation) levanta ValueError
+
+    Attributes
+    ----------
+    correlation: ndarray
+        Matriz de correlação de Pearson (n x n)
+    distance: ndarray
+        Matriz de distância de Mantegna, sqrt(0.5 * (1 - correlation)) (n x n)
+    condensed: ndarray
+        Distância entre as linhas de distance, no formato condensado do pdist
+    covariance: ndarray
+        Matriz de covariância amostral (n x n)
+    volatility: ndarray
+        Desvio padrão amostral de cada ativo (n,)
+    '''
+    FIELDS = ('correlation', 'distance', 'condensed', 'covariance', 'volatility')
+
+    def __init__(self, assets, data=None, metric='euclidean', **precomputed):
+        unknown = set(precomputed) - set(self.FIELDS)
+        if unknown:
+            raise TypeError(f'WindowContext não conhece {sorted(unknown)}')
+        self._assets = tuple(assets)
+        self._data = data
+        self._metric = metric
+        self._values = {name: _read_only(value) for name, value in precomputed.items()}
+        self._linkages = {}
+
+    def _get(self, name):
+        if name not in self._values:
+            with profiling.stage(f'context.{name}'):
+                self._values[name] = _read_only(getattr(self, f'_compute_{name}')())
+        return self._values[name]
+
+    def _compute_correlation(self):
+        if self._data is not None:
+            return get_correlation(self._data)
+        return cov_to_corr(self.covariance)
+
+    def _compute_covariance(self):
+        if self._data is None:
+            raise ValueError('WindowContext sem data: a covariância precisa ser informada em precomputed '
+                             f'(disponíveis: {sorted(self._values)})')
+        return self._data.cov()
+
+    def _compute_volatility(self):
+        if self._data is not None and 'covariance' not in self._values:
+            return self._data.std()
+        return np.sqrt(np.diag(self.covariance))
+
+    def _compute_distance(self):
+        return calc_distance(self.correlation)
+
+    def _compute_condensed(self):
+        return condensed_distance(self.distance, self._metric)
+
+    assets = property(lambda self: self._assets)
+    metric = property(lambda self: self._metric)
+    correlation = property(lambda self: self._get('correlation'))
+    distance = property(lambda self: self._get('distance'))
+    condensed = property(lambda self: self._get('condensed'))
+    covariance = property(lambda self: self._get('covariance'))
+    volatility = property(lambda self: self._get('volatility'))
+
+    @property
+    def n_assets(self):
+        return len(self.assets)
+
+    def computed(self):
+        '''
+        Nomes das matrizes e linkages já calculados
+        '''
+        return set(self._values) | {f'linkage:{method}' for method, _ in self._linkages}
+
+    def linkage(self, method, optimal_ordering=True):
+        '''
+        Linkage matrix do scipy sobre condensed, calculada uma única vez por método e
+        compartilhada pelo linkage_cache com outros contextos de mesma distância
+
+        Parameters
+        ----------
+        method: str
+            Método de linkage ('ward', 'single', ...)
+        optimal_ordering: bool
+            Reordena as folhas para minimizar a distância entre folhas vizinhas (mais caro)
+        '''
+        key = (method, optimal_ordering)
+        if key not in self._linkages:
+            condensed = self.condensed
+            with profiling.stage(f'context.linkage.{method}'):
+                self._linkages[key] = _read_only(linkage_cache.linkage(condensed, method, optimal_ordering))
+        return self._linkages[key]
+
+    def square_distance(self):
+        '''
+        Retorna a distância euclidiana na forma quadrada (n x n), como o squareform do pdist
+        '''
+        return squareform(self.condensed)
+
+    def frame(self, matrix):
+        '''
+        Envolve uma das matrizes n x n do contexto em um DataFrame rotulado pelos tickers
+        '''
+        return pd.DataFrame(matrix, index=list(self.assets), columns=list(self.assets))
+
+
+def get_correlation(data):
+    return data.corr(method='pearson')
+
+def cov_to_corr(covariance):
+    covariance = np.asarray(covariance, dtype=float)
+    std = np.sqrt(np.diag(covariance))
+    correlation = np.clip(covariance / np.outer(std, std), -1, 1)
+    np.fill_diagonal(correlation, 1)
+    return correlation
+
+def calc_distance(correlation):
+    distance_corr = np.sqrt(0.5 * (1 - correlation))
+    return distance_corr
+
+def column_distance(distance, len_stocks=None, chunk_size=None):
+    '''
+    Distância entre as colunas da matriz de distância inspirada no artigo
+    https://www.diva-portal.org/smash/record.jsf?pid=diva2%3A1609991&dswid=-2657,
+    com a mesma saída do laço triplo de euclidian_distance_improve:
+
+        d_ij = sqrt( (D[n, i] - D[n, j]) ** 2 ) = |D[n, i] - D[n, j]|,  n = len_stocks - 1
+
+    O laço original sobrescreve a matriz a cada n, então só a última linha usada fica no
+    resultado: uma projeção na distância ao último ticker, que muda quando as colunas são
+    reordenadas. Por isso ela fica só como a versão vetorizada dos *_distance_improve, para
+    compatibilidade, e não é uma das DISTANCE_METRICS. (Somar sobre todas as linhas daria
+    exatamente o pdist de 'euclidean', porque D é simétrica.)
+
+    Parameters
+    ----------
+    distance: dataframe pandas ou ndarray
+        Matriz de distância de Mantegna (N x N)
+    len_stocks: int
+        Quantidade de linhas de distance percorridas pelo laço original, todas se None
+    chunk_size: int
+        Quantidade de linhas do resultado escritas por bloco
+
+    Return
+    ------
+    eucli_dist: dataframe pandas ou ndarray
+        Matriz N x N com as distâncias, com os mesmos rótulos de distance se for um DataFrame
+    '''
+    matrix = np.asarray(distance, dtype=float)
+    last = matrix[:len_stocks][-1]
+    n = matrix.shape[1]
+    step = max(int(chunk_size or n), 1)
+    eucli_dist = np.empty((n, n))
+    for start in range(0, n, step):
+        eucli_dist[start:start + step] = np.abs(last[start:start + step, None] - last[None, :])
+    if isinstance(distance, pd.DataFrame):
+        return pd.DataFrame(eucli_dist, index=distance.index, columns=distance.columns)
+    return eucli_dist
+
+def condensed_distance(distance, metric='euclidean'):
+    '''
+    Distância condensada entre os ativos, no formato aceito pelo linkage do scipy
+
+    Parameters
+    ----------
+    distance: dataframe pandas ou ndarray
+        Matriz de distância de Mantegna (N x N)
+    metric: str
+        Uma de DISTANCE_METRICS
+    '''
+    if metric == 'euclidean':
+        return pdist(distance, metric='euclidean')
+    raise ValueError(f'metric deve ser uma de {DISTANCE_METRICS}, recebido {metric!r}')
+
+def build_context(data, metric='euclidean', moments=None):
+    '''
+    Contexto com correlação, distância de Mantegna, distância euclidiana condensada, covariância
+    e linkages dos retornos de uma janela, calculados sob demanda.
+
+    Parameters
+    ----------
+    data: dataframe pandas
+        Retornos da janela, uma coluna por ativo
+    metric: str
+        Métrica da distância condensada, uma de DISTANCE_METRICS
+    moments: rolling.RollingMoments
+        Se informado, é atualizado com data e fornece a correlação e a covariância de
+        forma incremental em vez de data.corr() e data.cov()
+
+    Return
+    ------
+    context: WindowContext
+        Pacote com as matrizes da janela
+    '''
+    if moments is not None:
+        # as somas do RollingMoments andam com a janela seguinte, entao as matrizes desta janela
+        # sao copiadas agora
+        moments.update(data)
+        return WindowContext(data.columns, metric=metric,
+                             correlation=moments.correlation(), covariance=moments.covariance())
+    return WindowContext(data.columns, data, metric=metric)
+
+def as_context(data, metric='euclidean'):
+    '''
+    Permite que os mains aceitem tanto os retornos crus quanto um WindowContext já calculado.
+    Um WindowContext pronto mantém a métrica com que foi construído.
+    '''
+    if isinstance(data, WindowContext):
+        return data
+    return build_context(data, metric)
@@ -0,0 +1,201 @@
+'''
+Instrumentação das etapas dos alocadores: tempo de parede, quantidade de chamadas, pico de
+memória alocada e contadores (iterações e avaliações de função dos otimizadores) por etapa.
+
+As etapas são marcadas no código com
+
+    with profiling.stage('hrp.quasi_diag'):
+        ...
+
+    @profiling.profiled('minha_etapa')
+    def funcao(...): ...
+
+    profiling.count('hrb.optimization', nit=res.nit, nfev=res.nfev)
+
+e só são medidas depois de profiling.enable(). Desligado (o padrão), stage() devolve sempre o
+mesmo context manager vazio e count() retorna na primeira linha, então as marcações podem
+ficar no código de produção. Com enable(memory=True) o pico de memória de cada etapa vem do
+tracemalloc, que deixa o código bem mais lento; por isso ele é opcional.
+
+Os tempos são inclusivos: uma etapa aninhada (context.linkage.ward dentro de allocator.HRP)
+também conta no tempo da etapa de fora.
+'''
+import time
+import tracemalloc
+from contextlib import nullcontext
+from functools import wraps
+
+import pandas as pd
+
+_enabled = False
+_memory = False
+# etapa -> StageStats da coleta atual
+_stats = {}
+# etapas abertas, para o pico de memória das etapas aninhadas
+_open = []
+_NULL = nullcontext()
+
+
+class StageStats:
+    '''
+    Acumulado de uma etapa.
+
+    Parameters
+    ----------
+    calls: int
+        Quantidade de vezes que a etapa rodou
+    seconds: float
+        Tempo de parede total
+    peak: int
+        Maior pico de memória alocada em uma chamada, em bytes; None se a etapa nunca rodou
+        com memory=True (peak_kb sai NaN, não 0)
+    counters: dict
+        Contadores somados de count(), ex.: {'nit': ..., 'nfev': ...}
+    '''
+    __slots__ = ('calls', 'seconds', 'peak', 'counters')
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.peak = None
+        self.counters = {}
+
+    def as_dict(self):
+        peak_kb = float('nan') if self.peak is None else self.peak / 1024
+        return {'calls': self.calls, 'seconds': self.seconds, 'peak_kb': peak_kb, **self.counters}
+
+
+def _get_stats(name):
+    stats = _stats.get(name)
+    if stats is None:
+        stats = _stats[name] = StageStats()
+    return stats
+
+
+class _Stage:
+    __slots__ = ('name', 'start', 'base', 'peak')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        if _memory:
+            current, peak = tracemalloc.get_traced_memory()
+            # o pico acumulado ate aqui pertence a etapa de fora, que o guarda antes do reset
+            if _open: _open[-1].peak = max(_open[-1].peak, peak)
+            tracemalloc.reset_peak()
+            self.base, self.peak = current, current
+        _open.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        _open.pop()
+        stats = _get_stats(self.name)
+        stats.calls += 1
+        stats.seconds += elapsed
+        if _memory:
+            peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+            stats.peak = max(stats.peak or 0, peak - self.base)
+            if _open: _open[-1].peak = max(_open[-1].peak, peak)
+        return False
+
+
+def stage(name):
+    '''
+    Context manager que mede a etapa name; um context manager vazio quando desligado
+    '''
+    if not _enabled: return _NULL
+    return _Stage(name)
+
+def profiled(name=None):
+    '''
+    Decorador que mede cada chamada da função como a etapa name (o __qualname__ se None)
+    '''
+    def decorator(func):
+        label = name or f'{func.__module__}.{func.__qualname__}'
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled: return func(*args, **kwargs)
+            with _Stage(label):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def count(name, **counters):
+    '''
+    Soma contadores na etapa name, ex.: count('hrb.optimization', nit=res.nit, nfev=res.nfev)
+    '''
+    if not _enabled: return
+    totals = _get_stats(name).counters
+    for key, value in counters.items():
+        totals[key] = totals.get(key, 0) + value
+
+def enable(memory=False):
+    '''
+    Liga a coleta; memory=True mede também o pico de memória de cada etapa com o tracemalloc
+    '''
+    global _enabled, _memory
+    _enabled = True
+    _memory = memory
+    if memory and not tracemalloc.is_tracing(): tracemalloc.start()
+
+def disable():
+    global _enabled, _memory
+    if _memory and tracemalloc.is_tracing(): tracemalloc.stop()
+    _enabled = False
+    _memory = False
+
+def is_enabled():
+    return _enabled
+
+def reset():
+    '''
+    Descarta o que foi coletado até aqui
+    '''
+    _stats.clear()
+
+def snapshot(reset=False):
+    '''
+    Coleta atual como {etapa: {'calls', 'seconds', 'peak_kb', contadores...}}, um dicionário
+    simples que pode voltar de um processo do pool (peak_kb é NaN sem memory=True); reset=True
+    começa uma nova coleta
+    '''
+    collected = {name: stats.as_dict() for name, stats in _stats.items()}
+    if reset: _stats.clear()
+    return collected
+
+def report(collected=None):
+    '''
+    Tabela etapa x (calls, seconds, peak_kb, contadores), ordenada pelo tempo total
+
+    Parameters
+    ----------
+    collected: dict
+        Saída de snapshot(); a coleta atual se None
+    '''
+    collected = snapshot() if collected is None else collected
+    table = pd.DataFrame.from_dict(collected, orient='index')
+    if table.empty: return table
+    table.index.name = 'stage'
+    return table.sort_values('seconds', ascending=False)
+
+def timing_table(per_window):
+    '''
+    Tabela por janela do backtest, uma linha por (janela, etapa), pronta para to_csv.
+
+    Parameters
+    ----------
+    per_window: dict
+        {janela: snapshot() da janela}
+
+    Return
+    ------
+    table: dataframe pandas
+        Índice (window, stage) e colunas calls, seconds, peak_kb e os contadores
+    '''
+    rows = [{'window': i, 'stage': name, **values}
+            for i, collected in sorted(per_window.items()) for name, values in collected.items()]
+    if not rows: return pd.DataFrame(columns=['calls', 'seconds', 'peak_kb'])
+    return pd.DataFrame(rows).set_index(['window', 'stage'])
@@ -0,0 +1,98 @@
+'''
+Armazenamento dos resultados do backtest em arrays float64 pré-alocados.
+
+Em vez de escrever célula a célula em DataFrames com .loc, cada janela grava suas linhas em
+arrays janelas x métodos e métodos x janelas x tickers. Os DataFrames são criados só quando
+pedidos, como visões sobre os arrays (sem cópia). Para execuções longas os arrays podem ficar
+em arquivos .npy mapeados em memória.
+'''
+import os
+
+import numpy as np
+import pandas as pd
+
+
+class ResultStore:
+    '''
+    Resultados de todas as janelas em arrays float64 (NaN onde não há valor).
+
+    Parameters
+    ----------
+    n_windows: int
+        Quantidade de janelas
+    methods: list
+        Nomes dos alocadores, na ordem dos vetores de pesos de cada janela
+    tickers: list
+        Todos os tickers do universo, colunas das matrizes janelas x tickers
+    path: str
+        Pasta onde os arrays são gravados como .npy mapeados em memória; None mantém em memória
+    '''
+    def __init__(self, n_windows, methods, tickers, path=None):
+        self.n_windows = n_windows
+        self.methods = list(methods)
+        self.tickers = pd.Index(tickers)
+        self.path = path
+        if path is not None: os.makedirs(path, exist_ok=True)
+        n_methods, n_tickers = len(self.methods), len(self.tickers)
+        self.Rport = self._allocate('Rport', (n_windows, n_methods))
+        self.sspw = self._allocate('sspw', (n_windows, n_methods))
+        self.r_oos = self._allocate('r_oos', (n_windows, n_tickers))
+        self.weights = self._allocate('weights', (n_methods, n_windows, n_tickers))
+
+    def _allocate(self, name, shape):
+        if self.path is None:
+            return np.full(shape, np.nan)
+        array = np.lib.format.open_memmap(os.path.join(self.path, f'{name}.npy'), mode='w+',
+                                          dtype=np.float64, shape=shape)
+        array[...] = np.nan
+        return array
+
+    def record(self, i, assets, weights, r_oos):
+        '''
+        Grava os resultados da janela i.
+
+        Parameters
+        ----------
+        i: int
+            Índice da janela
+        assets: list
+            Tickers da janela, na ordem dos vetores de pesos e de r_oos
+        weights: list
+            Um vetor de pesos por método, na ordem de methods
+        r_oos: ndarray
+            Retorno fora da amostra de cada ativo da janela
+        '''
+        columns = self.tickers.get_indexer(assets)
+        self.r_oos[i, columns] = r_oos
+        for m, w in enumerate(weights):
+            self.weights[m, i, columns] = w
+            self.Rport[i, m] = w @ r_oos
+            self.sspw[i, m] = np.sum(w ** 2)
+
+    def flush(self):
+        '''
+        Garante que os arrays mapeados em memória foram escritos no disco
+        '''
+        for array in (self.Rport, self.sspw, self.r_oos, self.weights):
+            if isinstance(array, np.memmap): array.flush()
+
+    def method_frame(self, array):
+        return pd.DataFrame(array, index=range(self.n_windows), columns=self.methods, copy=False)
+
+    def ticker_frame(self, array):
+        return pd.DataFrame(array, index=range(self.n_windows), columns=self.tickers, copy=False)
+
+    def rport_frame(self):
+        return self.method_frame(self.Rport)
+
+    def sspw_frame(self):
+        return self.method_frame(self.sspw)
+
+    def r_oos_frame(self):
+        return self.ticker_frame(self.r_oos)
+
+    def weights_frame(self, method):
+        '''
+        Pesos de um método, janelas x tickers, como visão sobre o array
+        '''
+        return self.ticker_frame(self.weights[self.methods.index(method)])
@@ -0,0 +1,128 @@
+'''
+Covariância e correlação de janelas deslizantes.
+
+Janelas consecutivas do backtest compartilham InS - 1 meses: sai um mês e entra outro. Em vez
+de recalcular data.cov() e data.corr() com todas as linhas, o RollingMoments guarda as somas e
+os produtos cruzados da janela e atualiza com uma soma e uma subtração de posto um, O(p²) por
+janela. Quando o conjunto de ativos elegíveis muda, as somas são recalculadas do zero.
+'''
+import numpy as np
+import pandas as pd
+
+
+class RollingMoments:
+    '''
+    Somas e produtos cruzados da janela atual, atualizados de forma incremental.
+
+    As somas são acumuladas em torno de um ponto de referência (a média da janela no último
+    recálculo completo), o que evita o cancelamento numérico de cross / n - mean * mean'.
+
+    Parameters
+    ----------
+    resync_every: int
+        Recalcula as somas do zero depois dessa quantidade de atualizações incrementais,
+        limitando o acúmulo de erro de arredondamento; None nunca força o recálculo
+    '''
+    def __init__(self, resync_every=240):
+        self.resync_every = resync_every
+        self.assets = None
+        self.index = None
+        self.values = None
+        self.updates = 0
+        self.resyncs = 0
+
+    def update(self, window):
+        '''
+        Move as somas para a nova janela.
+
+        Se os ativos forem os mesmos (em qualquer ordem) e a nova janela for a anterior
+        deslocada de k linhas, aplica k atualizações de posto um; caso contrário recalcula.
+
+        Parameters
+        ----------
+        window: dataframe pandas
+            Retornos da janela, uma coluna por ativo, indexados pela linha de origem
+
+        Return
+        ------
+        self: RollingMoments
+        '''
+        assets = tuple(window.columns)
+        values = window.to_numpy(dtype=float)
+        if self.assets is None or set(assets) != set(self.assets) or len(assets) != len(self.assets):
+            return self._resync(assets, window.index, values)
+        if assets != self.assets:
+            self._reorder(assets)
+        shift = self._shift(window.index)
+        if shift is None or (self.resync_every is not None and self.updates + shift > self.resync_every):
+            return self._resync(assets, window.index, values)
+        if shift:
+            removed = self.values[:shift] - self.reference
+            added = values[-shift:] - self.reference
+            self.sum += added.sum(axis=0) - removed.sum(axis=0)
+            self.cross += added.T @ added - removed.T @ removed
+            self.updates += shift
+        self.index = window.index
+        self.values = values
+        return self
+
+    def _shift(self, index):
+        # quantas linhas a janela andou; None se nao for a mesma janela deslocada
+        n = len(self.index)
+        if len(index) != n: return None
+        for k in range(n):
+            if self.index[k:].equals(index[:n - k]):
+                return k
+        return None
+
+    def _reorder(self, assets):
+        position = {asset: j for j, asset in enumerate(self.assets)}
+        order = np.array([position[asset] for asset in assets])
+        self.reference = self.reference[order]
+        self.sum = self.sum[order]
+        self.cross = self.cross[np.ix_(order, order)]
+        self.values = self.values[:, order]
+        self.assets = assets
+
+    def _resync(self, assets, index, values):
+        self.assets = assets
+        self.index = index
+        self.values = values
+        self.reference = values.mean(axis=0)
+        centered = values - self.reference
+        self.sum = centered.sum(axis=0)
+        self.cross = centered.T @ centered
+        self.updates = 0
+        self.resyncs += 1
+        return self
+
+    @property
+    def n_obs(self):
+        return self.values.shape[0]
+
+    def mean(self):
+        return self.reference + self.sum / self.n_obs
+
+    def covariance(self):
+        '''
+        Covariância amostral (ddof = 1) da janela atual, como data.cov()
+        '''
+        n = self.n_obs
+        shifted_mean = self.sum / n
+        return (self.cross - n * np.outer(shifted_mean, shifted_mean)) / (n - 1)
+
+    def volatility(self):
+        return np.sqrt(np.diag(self.covariance()))
+
+    def correlation(self):
+        '''
+        Correlação de Pearson da janela atual, como data.corr(method='pearson')
+        '''
+        cov = self.covariance()
+        std = np.sqrt(np.diag(cov))
+        correlation = np.clip(cov / np.outer(std, std), -1, 1)
+        np.fill_diagonal(correlation, 1)
+        return correlation
+
+    def frame(self, matrix):
+        return pd.DataFrame(matrix, index=list(self.assets), columns=list(self.assets))
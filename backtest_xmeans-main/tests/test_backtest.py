@@ -0,0 +1,75 @@
+'''
+Consistência do EligibilityIndex com o window_assets (get_composition + contagem de NaN por
+janela) em dados sintéticos, e estado do processo depois de um backtest com max_workers=1.
+'''
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import backtest
+import pipeline
+import profiling
+
+
+def synthetic_inputs(n_rows, n_tickers, seed, lag_months=0):
+    '''
+    Retornos com ativos que entram e saem (blocos de NaN no começo e no fim e buracos isolados)
+    e uma composição com as mesmas linhas, datas atrasadas em lag_months, um ativo só da
+    composição e um ativo que nunca esteve nela.
+    '''
+    rng = np.random.RandomState(seed)
+    tickers = [f'T{j:02d}' for j in range(n_tickers)]
+    dates = pd.date_range('2000-01-31', periods=n_rows, freq='ME')
+    returns = rng.normal(size=(n_rows, n_tickers))
+    for j in range(n_tickers):
+        start, stop = sorted(rng.randint(0, n_rows, size=2))
+        if rng.rand() < 0.5: returns[:start, j] = np.nan
+        if rng.rand() < 0.3: returns[stop:, j] = np.nan
+        returns[rng.rand(n_rows) < 0.02, j] = np.nan
+    stocks = pd.DataFrame(returns, columns=tickers)
+    stocks.insert(0, 'dates', dates)
+
+    listed = tickers[:-1] + ['EXTRA']
+    member = np.where(rng.rand(n_rows, len(listed)) < 0.8, 1.0, np.nan)
+    composition = pd.DataFrame(member, columns=listed)
+    composition.insert(0, 'dates', dates + pd.DateOffset(months=lag_months))
+    return stocks, composition
+
+
+@pytest.mark.parametrize('InS', [2, 5, 12])
+@pytest.mark.parametrize('lag_months', [0, 1, 7])
+@pytest.mark.parametrize('seed', [0, 1])
+def test_matches_window_assets(InS, lag_months, seed):
+    stocks, composition = synthetic_inputs(40, 15, seed, lag_months)
+    eligibility = backtest.EligibilityIndex(stocks, composition, InS)
+    assert len(eligibility) == stocks.shape[0] - InS
+    for i in range(len(eligibility)):
+        assert eligibility.assets(i) == backtest.window_assets(stocks, composition, i, InS), i
+
+def test_composition_without_rows_in_window():
+    # composição que começa depois de todas as janelas: o get_composition não encontra linha
+    # e só os ativos sem NaN nos retornos (e presentes na composição) entram
+    stocks, composition = synthetic_inputs(30, 10, 3, lag_months=60)
+    eligibility = backtest.EligibilityIndex(stocks, composition, 6)
+    for i in range(len(eligibility)):
+        assets = backtest.window_assets(stocks, composition, i, 6)
+        assert eligibility.assets(i) == assets
+        assert 'T09' not in assets
+
+def test_serial_run_restores_process_state(tmp_path):
+    # com max_workers=1 o backtest roda no próprio processo; o linkage_cache em disco e o
+    # profiling da execução não podem ficar valendo para o código que chamou
+    stocks, composition = synthetic_inputs(40, 15, 0)
+    previous = pipeline.linkage_cache
+    engine = backtest.WalkForwardEngine(stocks, composition, InS=12, max_workers=1, verbose=False,
+                                        methods=['HRP'], linkage_cache_dir=str(tmp_path), profile=True)
+    result = engine.run()
+    assert pipeline.linkage_cache is previous
+    assert not profiling.is_enabled()
+    assert any(tmp_path.iterdir())
+    assert result.Rport.shape == (len(engine.windows()), 1)
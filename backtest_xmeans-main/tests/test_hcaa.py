@@ -0,0 +1,100 @@
+'''
+Consistência da hcaa.ArrayTree e do create_tree_from_clusters iterativo com a árvore Tree
+montada pela recursão original.
+'''
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+import scipy.cluster.hierarchy as hr
+from scipy.spatial.distance import pdist
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import hcaa
+
+
+def correlation_linkage(n_assets, method, seed):
+    # mesma cadeia do HCAA: correlação -> distância de Mantegna -> pdist -> linkage
+    rng = np.random.RandomState(seed)
+    returns = rng.normal(size=(120, 3)) @ rng.normal(size=(3, n_assets)) + rng.normal(size=(120, n_assets))
+    distance = np.sqrt(0.5 * (1 - np.corrcoef(returns, rowvar=False)))
+    return hr.linkage(pdist(distance), method=method, optimal_ordering=True)
+
+def chain_linkage(n_assets):
+    # cada união junta um único ativo ao cluster anterior: a árvore tem altura n_assets - 1
+    points = np.cumsum(np.arange(1, n_assets + 1, dtype=float))[:, None]
+    return hr.linkage(points, method='single')
+
+def recursive_tree(cluster, dicio, raiz, len_asset):
+    # create_tree_from_clusters original, recursivo
+    for i, subcluster in enumerate(cluster):
+        node = hcaa.Tree(subcluster)
+        if i == 0: raiz.left = node
+        else: raiz.right = node
+        if subcluster >= len_asset:
+            recursive_tree(dicio[subcluster], dicio, node, len_asset)
+
+def build_tree(link, recursive):
+    # como o main original: raiz com os dois últimos clusters combinados e peso 100
+    n_assets = len(link) + 1
+    merged = hcaa.get_idx_cluster_merged(link, n_assets)
+    cluster = merged[max(merged)]
+    raiz = hcaa.Tree(cluster, 100)
+    (recursive_tree if recursive else hcaa.create_tree_from_clusters)(cluster, merged, raiz, n_assets)
+    return raiz
+
+def preorder(raiz):
+    # (valor, profundidade) de cada nó, da esquerda para a direita
+    nodes, stack = [], [(raiz, 0)]
+    while stack:
+        node, depth = stack.pop()
+        nodes.append((node.data if node is not raiz else None, depth))
+        for child in (node.right, node.left):
+            if child is not None: stack.append((child, depth + 1))
+    return nodes
+
+def loop_depth(link):
+    # profundidade de cada nó da raiz para baixo, nó interno a nó interno
+    n = len(link) + 1
+    depth = np.zeros(2 * n - 1, dtype=int)
+    for k in range(n - 2, -1, -1):
+        depth[int(link[k, 0])] = depth[int(link[k, 1])] = depth[n + k] + 1
+    return depth
+
+
+CASES = [(method, n_assets, seed) for method in ('ward', 'single', 'average')
+         for n_assets in (2, 3, 17, 64) for seed in (0, 1)]
+
+@pytest.mark.parametrize('method, n_assets, seed', CASES)
+def test_iterative_tree_matches_recursive(method, n_assets, seed):
+    link = correlation_linkage(n_assets, method, seed)
+    assert preorder(build_tree(link, False)) == preorder(build_tree(link, True))
+
+@pytest.mark.parametrize('method, n_assets, seed', CASES)
+def test_array_tree_matches_tree(method, n_assets, seed):
+    link = correlation_linkage(n_assets, method, seed)
+    raiz = build_tree(link, True)
+    tree = hcaa.ArrayTree.from_linkage(link, 100)
+    leaves = [data for data, _ in preorder(raiz) if data is not None and data < n_assets]
+    assert tree.leaves().tolist() == leaves == hr.leaves_list(link).tolist()
+    np.testing.assert_array_equal(tree.depth(), loop_depth(link))
+    assert hcaa.weight_tree(tree) == hcaa.weight_tree(raiz)
+
+@pytest.mark.parametrize('n_assets', [2, 10, 3000])
+def test_chain(n_assets):
+    # altura n_assets - 1: a recursão original passaria do limite de recursão do Python
+    link = chain_linkage(n_assets)
+    tree = hcaa.ArrayTree.from_linkage(link, 100)
+    assert tree.leaves().tolist() == hr.leaves_list(link).tolist()
+    np.testing.assert_array_equal(tree.depth(), loop_depth(link))
+    assert hcaa.weight_tree(tree) == hcaa.weight_tree(build_tree(link, False))
+
+def test_main_matches_tree_weights():
+    rng = np.random.RandomState(4)
+    returns = pd.DataFrame(rng.normal(size=(119, 3)) @ rng.normal(size=(3, 30)) + rng.normal(size=(119, 30)))
+    link = hr.linkage(pdist(np.sqrt(0.5 * (1 - returns.corr().to_numpy()))), method='ward', optimal_ordering=True)
+    expected = np.array(hcaa.weight_tree(build_tree(link, True))) / 100
+    np.testing.assert_array_equal(hcaa.main(returns), expected)
@@ -0,0 +1,60 @@
+'''
+Consistência de hrb.construir_matriz_similaridade com o laço original sobre a matriz
+(2n-1) x (2n-1) e com o hr.cophenet.
+'''
+import os
+import sys
+
+import numpy as np
+import pytest
+import scipy.cluster.hierarchy as hr
+from scipy.spatial.distance import pdist, squareform
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import hrb
+
+
+def correlation_linkage(n_assets, method, seed, optimal_ordering):
+    # mesma cadeia do HRB: correlação -> distância de Mantegna -> pdist -> linkage
+    rng = np.random.RandomState(seed)
+    returns = rng.normal(size=(120, 3)) @ rng.normal(size=(3, n_assets)) + rng.normal(size=(120, n_assets))
+    distance = np.sqrt(0.5 * (1 - np.corrcoef(returns, rowvar=False)))
+    return hr.linkage(pdist(distance), method=method, optimal_ordering=optimal_ordering)
+
+def loop_similarity(clustering_matrix, num_assets):
+    # construir_matriz_similaridade original: mapa de membros por cluster e laço duplo por união
+    matriz = np.zeros((num_assets + len(clustering_matrix),) * 2)
+    cluster_map = {i: [i] for i in range(num_assets)}
+    for i, (cluster1, cluster2, altura, _) in enumerate(clustering_matrix):
+        cluster1, cluster2 = int(cluster1), int(cluster2)
+        cluster_map[num_assets + i] = cluster_map[cluster1] + cluster_map[cluster2]
+        for elem1 in cluster_map[cluster1]:
+            for elem2 in cluster_map[cluster2]:
+                matriz[elem1, elem2] = altura
+                matriz[elem2, elem1] = altura
+    return matriz[:num_assets, :num_assets]
+
+
+@pytest.mark.parametrize('method', ['single', 'ward', 'average'])
+@pytest.mark.parametrize('optimal_ordering', [False, True])
+@pytest.mark.parametrize('n_assets', [2, 3, 17, 80])
+def test_matches_loop(method, optimal_ordering, n_assets):
+    link = correlation_linkage(n_assets, method, n_assets, optimal_ordering)
+    assets = [f'T{j:03d}' for j in range(n_assets)]
+    matriz = hrb.construir_matriz_similaridade(link, assets)
+    assert matriz.index.tolist() == assets and matriz.columns.tolist() == assets
+    np.testing.assert_array_equal(matriz.to_numpy(), loop_similarity(link, n_assets))
+
+@pytest.mark.parametrize('n_assets', [5, 40])
+def test_matches_cophenet(n_assets):
+    link = correlation_linkage(n_assets, 'single', 7, False)
+    matriz = hrb.construir_matriz_similaridade(link, list(range(n_assets)))
+    np.testing.assert_allclose(matriz.to_numpy(), squareform(hr.cophenet(link)))
+
+def test_tied_heights():
+    # pontos repetidos: várias uniões com altura 0 e clusters que juntam outros clusters
+    points = np.array([[0.], [0.], [1.], [1.], [1.], [5.], [5.], [9.]])
+    link = hr.linkage(points, method='single')
+    matriz = hrb.construir_matriz_similaridade(link, list(range(len(points))))
+    np.testing.assert_array_equal(matriz.to_numpy(), loop_similarity(link, len(points)))
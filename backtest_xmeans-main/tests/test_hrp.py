@@ -0,0 +1,116 @@
+'''
+Consistência de hrp.quasi_diag_order com a implementação original getQuasiDiag e de
+hrp.recursive_bisection com o recursive bisection original em pandas.
+'''
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+import scipy.cluster.hierarchy as hr
+from scipy.spatial.distance import pdist
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import hrp
+import pipeline
+
+
+def correlation_linkage(n_assets, method, seed):
+    # mesma cadeia do pipeline: correlação -> distância de Mantegna -> pdist -> linkage
+    rng = np.random.RandomState(seed)
+    returns = rng.normal(size=(120, 3)) @ rng.normal(size=(3, n_assets)) + rng.normal(size=(120, n_assets))
+    distance = np.sqrt(0.5 * (1 - np.corrcoef(returns, rowvar=False)))
+    return hr.linkage(pdist(distance), method=method, optimal_ordering=True)
+
+def chain_linkage(n_assets):
+    # pontos com espaçamento crescente: cada união junta um único ativo ao cluster anterior
+    points = np.cumsum(np.arange(1, n_assets + 1, dtype=float))[:, None]
+    link = hr.linkage(points, method='single')
+    assert (link[1:, :2].max(axis=1) >= n_assets).all()
+    return link
+
+
+def random_covariance(n_assets, seed):
+    # covariância amostral com fatores comuns e volatilidades bem diferentes entre os ativos
+    rng = np.random.RandomState(seed)
+    returns = rng.normal(size=(120, 4)) @ rng.normal(size=(4, n_assets)) + rng.normal(size=(120, n_assets))
+    returns *= rng.uniform(0.5, 5, size=n_assets)
+    tickers = [f'T{j:03d}' for j in range(n_assets)]
+    return pd.DataFrame(np.cov(returns, rowvar=False), index=tickers, columns=tickers)
+
+def pandas_recursive_bisection(covariance_matrix, sortIx):
+    # recursive_bisection original, com getClusterVar sobre os rótulos do DataFrame
+    w = pd.Series(1., index=sortIx)
+    cItems = [sortIx]
+    while len(cItems) > 0:
+        cItems = [i[j:k] for i in cItems for j, k in ((0, len(i) // 2), (len(i) // 2, len(i))) if len(i) > 1]
+        for i in range(0, len(cItems), 2):
+            cItems0 = cItems[i]; cItems1 = cItems[i + 1]
+            cVar0 = hrp.getClusterVar(covariance_matrix, cItems0)
+            cVar1 = hrp.getClusterVar(covariance_matrix, cItems1)
+            alpha = 1 - cVar0 / (cVar0 + cVar1)
+            w[cItems0] *= float(alpha)
+            w[cItems1] *= float(1 - alpha)
+    return w
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    hrp._quasi_diag_cache.clear()
+
+
+@pytest.mark.parametrize('method', ['ward', 'single', 'average'])
+@pytest.mark.parametrize('n_assets', [2, 3, 17, 64])
+@pytest.mark.parametrize('seed', [0, 1])
+def test_matches_getQuasiDiag(method, n_assets, seed):
+    link = correlation_linkage(n_assets, method, seed)
+    assert hrp.quasi_diag_order(link).tolist() == hrp.getQuasiDiag(link)
+
+@pytest.mark.parametrize('n_assets', [2, 10, 200])
+def test_chain_matches_getQuasiDiag(n_assets):
+    link = chain_linkage(n_assets)
+    assert hrp.quasi_diag_order(link).tolist() == hrp.getQuasiDiag(link)
+
+def test_right_children_are_appended():
+    # a ordem de getQuasiDiag não é a ordem em profundidade do leaves_list: o filho da direita
+    # de cada cluster vai para o final da sequência
+    points = np.array([[0.], [1.], [10.], [11.], [30.], [31.], [60.], [61.]])
+    link = hr.linkage(points, method='single')
+    order = hrp.quasi_diag_order(link).tolist()
+    assert order == [6, 4, 7, 0, 5, 2, 1, 3]
+    assert order == hrp.getQuasiDiag(link)
+    assert order != hr.leaves_list(link).tolist()
+
+def test_order_is_a_permutation_and_read_only():
+    link = correlation_linkage(30, 'ward', 0)
+    order = hrp.quasi_diag_order(link)
+    assert sorted(order.tolist()) == list(range(30))
+    assert not order.flags.writeable
+
+def test_cache_returns_same_order():
+    link = correlation_linkage(25, 'ward', 3)
+    first = hrp.quasi_diag_order(link)
+    assert hrp.quasi_diag_order(link.copy()) is first
+
+@pytest.mark.parametrize('n_assets', [2, 3, 17, 64])
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_recursive_bisection_matches_pandas(n_assets, seed):
+    cov = random_covariance(n_assets, seed)
+    link = hr.linkage(pdist(np.sqrt(0.5 * (1 - pipeline.cov_to_corr(cov.to_numpy())))), method='ward')
+    sortIx = cov.index[hrp.quasi_diag_order(link)].tolist()
+    weights = hrp.recursive_bisection(cov, sortIx)
+    expected = pandas_recursive_bisection(cov, sortIx)
+    assert weights.index.tolist() == sortIx
+    np.testing.assert_allclose(weights.to_numpy(), expected.to_numpy(), rtol=1e-10, atol=1e-14)
+    assert weights.sum() == pytest.approx(1)
+
+@pytest.mark.parametrize('seed', [0, 1])
+def test_recursive_bisection_weights_any_order(seed):
+    # a ordem não precisa ser a quasi-diagonal: os intervalos saem de qualquer permutação
+    cov = random_covariance(33, seed)
+    sortIx = cov.index[np.random.RandomState(seed).permutation(33)].tolist()
+    sorted_cov = cov.loc[sortIx, sortIx].to_numpy()
+    np.testing.assert_allclose(hrp.recursive_bisection_weights(sorted_cov),
+                               pandas_recursive_bisection(cov, sortIx).to_numpy(), rtol=1e-10, atol=1e-14)
@@ -0,0 +1,42 @@
+'''
+Pico de memória das etapas do profiling com e sem memory=True.
+'''
+import math
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import profiling
+
+
+@pytest.fixture(autouse=True)
+def clean_profiling():
+    profiling.reset()
+    yield
+    profiling.disable()
+    profiling.reset()
+
+
+def test_peak_is_nan_without_memory():
+    profiling.enable()
+    with profiling.stage('alloc'):
+        np.ones(100_000)
+    profiling.count('counted', nit=3)
+    collected = profiling.snapshot()
+    assert math.isnan(collected['alloc']['peak_kb'])
+    assert math.isnan(collected['counted']['peak_kb'])
+    assert collected['counted']['nit'] == 3
+
+def test_peak_is_measured_with_memory():
+    profiling.enable(memory=True)
+    with profiling.stage('alloc'):
+        np.ones(100_000)
+    with profiling.stage('empty'):
+        pass
+    collected = profiling.snapshot()
+    assert collected['alloc']['peak_kb'] >= 100_000 * 8 / 1024
+    assert collected['empty']['peak_kb'] >= 0
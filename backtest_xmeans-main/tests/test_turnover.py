@@ -0,0 +1,63 @@
+'''
+Consistência do turnover vetorizado (turnover.py) com o laço do notebook, que chama
+backtest.calculate_to por janela e por método a partir de i > 2.
+'''
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import backtest
+import results
+import turnover
+
+METHODS = ['x_means', 'HCAA', 'HRP']
+
+
+def synthetic_store(n_windows, n_tickers, seed):
+    # universos que mudam entre as janelas, pesos aleatórios e alguns retornos fora da amostra
+    # faltantes, gravados como no WalkForwardEngine
+    rng = np.random.RandomState(seed)
+    tickers = [f'T{j:02d}' for j in range(n_tickers)]
+    store = results.ResultStore(n_windows, METHODS, tickers)
+    for i in range(n_windows):
+        aux = [t for t in tickers if rng.rand() < 0.7] or tickers[:1]
+        r_oos = rng.normal(scale=8, size=len(aux))
+        r_oos[rng.rand(len(aux)) < 0.05] = np.nan
+        store.record(i, aux, [rng.dirichlet(np.ones(len(aux))) for _ in METHODS], r_oos)
+    return store
+
+def loop_turnover(store):
+    # laço do notebook: DataFrames w_*_full com os pesos por ticker e r_oos_full de uma linha
+    full = {method: store.weights_frame(method) for method in METHODS}
+    to = pd.DataFrame(np.nan, index=range(store.n_windows - 1), columns=METHODS)
+    for i in range(store.n_windows):
+        r_oos_full = pd.DataFrame([store.r_oos[i]], index=[0], columns=store.tickers)
+        if i > 2:
+            to.loc[i - 1, :] = [backtest.calculate_to(full[method].loc[i - 1, :], full[method].loc[i, :], r_oos_full, None)
+                                for method in METHODS]
+    return to
+
+
+@pytest.mark.parametrize('n_windows, n_tickers', [(4, 3), (12, 8), (40, 25)])
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_matches_calculate_to(n_windows, n_tickers, seed):
+    store = synthetic_store(n_windows, n_tickers, seed)
+    expected = loop_turnover(store)
+    two_way = turnover.turnover_frame(store)
+    assert two_way.index.tolist() == expected.index.tolist()
+    assert two_way.columns.tolist() == METHODS
+    np.testing.assert_allclose(two_way.to_numpy(), expected.to_numpy(dtype=float), rtol=1e-12, atol=1e-15)
+
+def test_report_costs():
+    store = synthetic_store(15, 10, 4)
+    expected = loop_turnover(store).to_numpy(dtype=float)
+    report = turnover.turnover_report(store, cost=0.001)
+    np.testing.assert_allclose(report.one_way.to_numpy(), expected / 2, rtol=1e-12)
+    # a janela i paga o turnover da linha i - 1; janelas sem turnover não pagam custo
+    paid = np.vstack([np.zeros((1, len(METHODS))), np.nan_to_num(expected, nan=0.0)])
+    np.testing.assert_allclose(report.net_returns.to_numpy(), store.Rport - 0.1 * paid, rtol=1e-12)
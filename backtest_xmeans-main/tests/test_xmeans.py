@@ -0,0 +1,129 @@
+'''
+Consistência dos split_engine do XMeans ('kmeans' e 'lloyd') com o split_clusters original e
+do merge_result vetorizado com os laços de renumeração originais.
+'''
+import os
+import sys
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pipeline
+import xmeans
+
+ENGINES = ['kmeans', 'lloyd']
+
+
+def distance_matrix(n_assets, seed):
+    # mesma entrada do xmeans.main: retornos com setores -> WindowContext -> square_distance
+    rng = np.random.RandomState(seed)
+    sector = rng.randint(max(n_assets // 8, 2), size=n_assets)
+    factors = rng.normal(size=(119, sector.max() + 1))
+    returns = factors[:, sector] * 4 + rng.normal(size=(119, n_assets)) * 6
+    frame = pd.DataFrame(returns, columns=[f'A{j:03d}' for j in range(n_assets)])
+    return pipeline.build_context(frame).square_distance()
+
+def fit(engine, data, seed):
+    # resultado do fit ou o tipo do erro (o X-Means original falha para algumas seeds)
+    try:
+        return xmeans.XMeans(split_engine=engine).fit(data, seed)
+    except xmeans.CenterRenumberError as error:
+        return type(error)
+
+def assert_same_fit(result, expected):
+    if isinstance(expected, type):
+        assert result is expected
+        return
+    assert not isinstance(result, type)
+    np.testing.assert_array_equal(result['cluster'], expected['cluster'])
+    np.testing.assert_array_equal(np.concatenate(result['size']), np.concatenate(expected['size']))
+    for got, want in zip(result['centers'], expected['centers']):
+        np.testing.assert_allclose(got, want, rtol=1e-7, atol=1e-9)
+
+def loop_merge_result(labels, clsub, ik):
+    # merge_result original: np.where por sub-cluster, do último cluster inicial para o primeiro
+    cluster = labels.copy()
+    k = sum(len(clsub[i][2]) for i in range(ik))
+    for i in range(ik, 0, -1):
+        xsub = clsub[i - 1][0].copy()
+        for j in range(len(clsub[i - 1][2]), 0, -1):
+            xsub[xsub == j] = k
+            k = k - 1
+        cluster[np.where(cluster == (i - 1))] = xsub
+    assert k == 0
+    return cluster
+
+def random_split(n_elements, k_min, seed):
+    # rótulos do KMeans inicial e, para cada cluster inicial, rótulos 1..m dos sub-clusters
+    rng = np.random.RandomState(seed)
+    labels = np.concatenate([np.arange(k_min), rng.randint(k_min, size=n_elements - k_min)])
+    rng.shuffle(labels)
+    clsub = []
+    for i in range(k_min):
+        members = np.count_nonzero(labels == i)
+        n_sub = rng.randint(1, members + 1)
+        sub = np.concatenate([np.arange(1, n_sub + 1), rng.randint(1, n_sub + 1, size=members - n_sub)])
+        rng.shuffle(sub)
+        clsub.append((sub, rng.normal(size=(n_sub, 3)), np.bincount(sub, minlength=n_sub + 1)[1:]))
+    return labels, clsub
+
+
+@pytest.fixture(scope='module')
+def datasets():
+    return {(n_assets, seed): distance_matrix(n_assets, seed) for n_assets in (40, 90) for seed in (0, 1)}
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+@pytest.mark.parametrize('key', [(40, 0), (40, 1), (90, 0), (90, 1)])
+@pytest.mark.parametrize('seed', [0, 3, 11])
+def test_integer_seed_matches_original(datasets, engine, key, seed):
+    data = datasets[key]
+    assert_same_fit(fit(engine, data, seed), fit(None, data, seed))
+
+@pytest.mark.parametrize('engine', ENGINES)
+@pytest.mark.parametrize('key', [(40, 0), (90, 1)])
+@pytest.mark.parametrize('global_seed', [0, 3, 11])
+def test_global_seed_draws_one_integer_seed(datasets, engine, key, global_seed):
+    # o caminho do backtest: np.random.seed(i) e fit com seed=None
+    data = datasets[key]
+    np.random.seed(global_seed)
+    result = fit(engine, data, None)
+    drawn = int(np.random.RandomState(global_seed).randint(np.iinfo(np.int32).max))
+    assert_same_fit(result, fit(None, data, drawn))
+
+@pytest.mark.parametrize('key', [(40, 0), (40, 1), (90, 0), (90, 1)])
+@pytest.mark.parametrize('global_seed', [0, 3, 11])
+def test_engines_agree_with_global_seed(datasets, key, global_seed):
+    data = datasets[key]
+    results = []
+    for engine in ENGINES:
+        np.random.seed(global_seed)
+        results.append(fit(engine, data, None))
+    assert_same_fit(results[1], results[0])
+
+def test_global_seed_is_reproducible(datasets):
+    data = datasets[(90, 0)]
+    np.random.seed(5)
+    first = fit('lloyd', data, None)
+    np.random.seed(5)
+    assert_same_fit(fit('lloyd', data, None), first)
+
+@pytest.mark.parametrize('n_elements, k_min', [(2, 2), (10, 2), (60, 3), (200, 5)])
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_merge_result_matches_loop(n_elements, k_min, seed):
+    labels, clsub = random_split(n_elements, k_min, seed)
+    expected = loop_merge_result(labels, clsub, k_min)
+    merged = xmeans.XMeans(k_min=k_min).merge_result(SimpleNamespace(labels_=labels.copy()), clsub, k_min)
+    np.testing.assert_array_equal(merged['cluster'], expected)
+    assert [len(size) for size in merged['size']] == [len(sub[2]) for sub in clsub]
+    assert all(center is sub[1] for center, sub in zip(merged['centers'], clsub))
+
+def test_relabel_gather_keeps_element_order():
+    labels = np.array([1, 0, 1, 1, 0])
+    relabel = xmeans.SubClusterRelabel(labels, [2, 1])
+    # cluster 0 (posições 1 e 4) com sub-clusters 2 e 1; cluster 1 (posições 0, 2 e 3) todo no 1
+    np.testing.assert_array_equal(relabel.gather([np.array([2, 1]), np.array([1, 1, 1])]), [3, 2, 3, 3, 1])
@@ -0,0 +1,117 @@
+'''
+Drift dos pesos e turnover de todas as janelas e métodos de uma vez.
+
+O calculate_to do backtest trata uma janela e um método por chamada. Aqui as mesmas contas são
+feitas sobre o array métodos x janelas x tickers do ResultStore:
+
+    num      = w[i - 1] * (1 + r_oos[i] / 100)      (r_oos faltante vale 0)
+    drift    = num / nansum(num)
+    turnover = nansum(|w[i] - drift|)                (guardado na linha i - 1)
+
+Como no calculate_to, ativos que entram ou saem do universo (NaN em w[i] ou em w[i - 1]) não
+entram na soma do turnover.
+'''
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+
+def drift_weights(weights, r_oos):
+    '''
+    Pesos da janela i - 1 depois de um mês de retornos, já normalizados.
+
+    Parameters
+    ----------
+    weights: ndarray
+        Pesos, métodos x janelas x tickers (NaN fora do universo)
+    r_oos: ndarray
+        Retornos fora da amostra em %, janelas x tickers
+
+    Return
+    ------
+    drift: ndarray
+        métodos x (janelas - 1) x tickers; drift[:, i - 1] vem dos pesos da janela i - 1 com os
+        retornos da janela i
+    '''
+    growth = 1 + np.nan_to_num(np.asarray(r_oos, dtype=float)[1:], nan=0.0) / 100
+    num = np.asarray(weights, dtype=float)[:, :-1] * growth
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return num / np.nansum(num, axis=-1, keepdims=True)
+
+def turnover(weights, r_oos, min_window=3):
+    '''
+    Turnover (soma das diferenças absolutas, ida e volta) de todas as janelas e métodos.
+
+    Parameters
+    ----------
+    weights: ndarray
+        Pesos, métodos x janelas x tickers (NaN fora do universo)
+    r_oos: ndarray
+        Retornos fora da amostra em %, janelas x tickers
+    min_window: int
+        Primeira janela com turnover calculado; as anteriores ficam NaN (o backtest usa 3)
+
+    Return
+    ------
+    to: ndarray
+        métodos x (janelas - 1); to[:, i - 1] é o turnover da janela i
+    '''
+    weights = np.asarray(weights, dtype=float)
+    diff = np.abs(weights[:, 1:] - drift_weights(weights, r_oos))
+    to = np.nansum(diff, axis=-1)
+    to[:, :max(min_window - 1, 0)] = np.nan
+    return to
+
+
+@dataclass
+class TurnoverReport:
+    '''
+    Turnover e retornos líquidos de custo, indexados como o DataFrame to do backtest.
+
+    Parameters
+    ----------
+    two_way: dataframe pandas
+        Turnover de ida e volta (compras + vendas), linha i - 1 para a janela i
+    one_way: dataframe pandas
+        Metade do turnover de ida e volta
+    net_returns: dataframe pandas
+        Rport menos cost * two_way (em %), janelas x métodos; janelas sem turnover não pagam custo
+    cost: float
+        Custo de transação por unidade de peso negociada (0.001 = 10 bps)
+    '''
+    two_way: pd.DataFrame
+    one_way: pd.DataFrame
+    net_returns: pd.DataFrame
+    cost: float
+
+
+def turnover_frame(store, min_window=3):
+    '''
+    Turnover de ida e volta do ResultStore no formato do DataFrame to (janelas - 1 x métodos)
+    '''
+    to = turnover(store.weights, store.r_oos, min_window)
+    return pd.DataFrame(to.T, index=range(store.n_windows - 1), columns=store.methods)
+
+def turnover_report(store, cost=0.0, min_window=3):
+    '''
+    Turnover de ida e volta, de ida e retornos ajustados pelo custo de transação.
+
+    Parameters
+    ----------
+    store: results.ResultStore
+        Resultados do backtest
+    cost: float
+        Custo de transação por unidade de peso negociada (0.001 = 10 bps)
+    min_window: int
+        Primeira janela com turnover calculado
+
+    Return
+    ------
+    report: TurnoverReport
+    '''
+    two_way = turnover_frame(store, min_window)
+    # o Rport esta em %, entao o custo da janela i e 100 * cost * turnover da janela i
+    paid = np.vstack([np.zeros((1, len(store.methods))), np.nan_to_num(two_way.to_numpy(), nan=0.0)])
+    net_returns = store.rport_frame() - 100 * cost * paid
+    return TurnoverReport(two_way=two_way, one_way=two_way / 2, net_returns=net_returns, cost=cost)
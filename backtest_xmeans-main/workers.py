@@ -0,0 +1,54 @@
+'''
+Execução de blocos de janelas em processos, compartilhada pelo WalkForwardEngine e pelo
+MonteCarloStudy.
+
+Cada motor define duas funções no nível do módulo (para que o pool consiga serializá-las):
+setup(*args), que guarda no processo o que é comum a todos os blocos (retornos, opções), e
+run_block(block), que processa um bloco de janelas com esse estado. run_blocks chama setup uma
+única vez por processo, pelo initializer do ProcessPoolExecutor, para que os retornos não sejam
+serializados junto com cada bloco; com max_workers=1 tudo roda no próprio processo, sem pool.
+'''
+from concurrent.futures import ProcessPoolExecutor
+
+
+def split_blocks(items, chunksize):
+    '''
+    items em blocos consecutivos de chunksize elementos (o último pode ser menor)
+    '''
+    return [items[k:k + chunksize] for k in range(0, len(items), chunksize)]
+
+def _init_worker(setup, args):
+    # cada processo usa um unico thread de BLAS, o paralelismo vem das janelas
+    from threadpoolctl import threadpool_limits
+    threadpool_limits(limits=1)
+    setup(*args)
+
+def run_blocks(run_block, blocks, max_workers, setup, args=()):
+    '''
+    Resultado de run_block para cada bloco, na ordem de blocks.
+
+    Parameters
+    ----------
+    run_block: função
+        Processa um bloco; precisa estar no nível de um módulo
+    blocks: list
+        Blocos de trabalho, ex.: saída de split_blocks
+    max_workers: int
+        Quantidade de processos; com 1 roda no próprio processo
+    setup: função
+        Chamada como setup(*args) uma vez em cada processo antes do primeiro bloco
+    args: tuple
+        Argumentos de setup
+
+    Return
+    ------
+    results: gerador
+        Um resultado de run_block por bloco, à medida que terminam em ordem
+    '''
+    if max_workers == 1:
+        setup(*args)
+        yield from map(run_block, blocks)
+        return
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker,
+                             initargs=(setup, args)) as executor:
+        yield from executor.map(run_block, blocks)
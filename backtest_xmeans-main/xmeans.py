@@ -1,10 +1,11 @@
 import numpy as np
 from sklearn.cluster import KMeans
+from sklearn.utils import check_random_state
 from scipy.stats import norm
 from scipy.spatial.distance import euclidean
 from scipy.spatial.distance import cdist
 from scipy.spatial.distance import pdist
-from scipy.linalg import solve, cholesky
+from scipy.linalg import solve, cholesky, solve_triangular
 from math import log
 from scipy import stats
 from scipy.optimize import minimize
@@ -12,6 +13,11 @@ import yfinance as yf
 import pandas as pd
 from scipy.stats import multivariate_normal
 from scipy.spatial.distance import pdist, squareform
+from dataclasses import dataclass
+from functools import lru_cache
+import warnings
+import pipeline
+import profiling
 
 '''
 X-Means usando KMeans
@@ -24,23 +30,340 @@ def calc_distance(correlation):
   distance_corr = np.sqrt(0.5 * (1 - correlation))
   return distance_corr
 
-def euclidian_distance_improve(len_stocks, distance_df):
-  eucli_dist = pd.DataFrame()
-  for n in range(len_stocks):
-    for k in range(( distance_df.shape[0] * distance_df.shape[1] )):
-      row = int(np.floor(k / distance_df.shape[1]))
-      col = k % distance_df.shape[1]
-      eucli_dist.loc[row, col] = np.sqrt((distance_df.iloc[n, row] - distance_df.iloc[n, col]) ** 2)
-  eucli_dist.index = distance_df.index
-  eucli_dist.columns = distance_df.columns
-  return eucli_dist
+def euclidian_distance_improve(len_stocks, distance_df, chunk_size=None):
+  # distancia entre as colunas inspirada no artigo do DiVA, vetorizada em pipeline.column_distance
+  return pipeline.column_distance(distance_df, len_stocks, chunk_size)
+
+def group_loglik(x, labels, centers, n_groups, ignore_covar):
+    '''
+    Log-verossimilhança normal de vários grupos de x em uma única chamada, usada por
+    XMeans.likehood (um grupo) e XMeans.likehood_split (os dois filhos de uma divisão).
+
+    Com ignore_covar (ou p == 1) a covariância de cada grupo é diagonal e todos os grupos
+    são resolvidos juntos: médias e variâncias por grupo saem de produtos com a matriz
+    indicadora dos grupos e a forma quadrática de um einsum. Com a covariância completa cada
+    grupo usa uma única fatoração de Cholesky para o solve e para o determinante.
+
+    determi segue a convenção do código original: o produto das variâncias no caso
+    diagonal e o produto da diagonal do fator de Cholesky (det ** 0.5) no caso completo.
+    O termo do determinante continua sendo -log(determi) / 2, inclusive quando o produto
+    estoura para 0 ou inf, para que as decisões de divisão sejam as mesmas de antes.
+
+    Parameters
+    ----------
+    x: ndarray
+        Dados (n x p)
+    labels: ndarray
+        Grupo de cada linha de x, inteiros em [0, n_groups)
+    centers: ndarray
+        Centro de cada grupo (n_groups x p)
+    n_groups: int
+        Quantidade de grupos
+    ignore_covar: bool
+        Usa somente a diagonal da covariância
+
+    Return
+    ------
+    lnl: ndarray
+        Log-verossimilhança de cada grupo, nan para grupos com 2 ou menos elementos
+    determi: ndarray
+        Determinante de cada grupo no formato descrito acima, nan junto com lnl
+    '''
+    x = np.asarray(x, dtype=float)
+    labels = np.asarray(labels)
+    p = x.shape[1]
+    counts = np.bincount(labels, minlength=n_groups)
+    lnl = np.full(n_groups, np.nan)
+    determi = np.full(n_groups, np.nan)
+    valid = counts > 2
+    if not valid.any(): return lnl, determi
+    xmu = x - np.asarray(centers, dtype=float)[labels]
+    t1 = -p/2 * 1.837877066 # 1.837... = log(2 * 3.1415...)
+    if ignore_covar or p == 1:
+        indicator = (labels[:, None] == np.arange(n_groups)).astype(float)
+        means = (indicator.T @ x) / np.maximum(counts, 1)[:, None]
+        dev = x - means[labels]
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore', under='ignore'):
+            var = (indicator.T @ (dev * dev)) / (counts - 1)[:, None]
+            prod_var = np.prod(var, axis=1)
+            t2 = -np.log(prod_var) / 2
+            s = np.bincount(labels, weights=np.einsum('ij,ij,ij->i', xmu, xmu, 1 / var[labels]), minlength=n_groups)
+        lnl[valid] = ((t1 + t2) * counts - s / 2)[valid]
+        determi[valid] = prod_var[valid]
+        return lnl, determi
+    for g in np.flatnonzero(valid):
+        members = labels == g
+        y = cholesky(np.cov(x[members], rowvar=False), lower=True) # vx = y %*% t(y)
+        z = solve_triangular(y, xmu[members].T, lower=True)      # y^-1 (x - mu)
+        determi[g] = np.prod(np.diag(y))
+        lnl[g] = (t1 - np.log(determi[g]) / 2) * counts[g] - np.einsum('ij,ij->', z, z) / 2
+    return lnl, determi
+
+def _random_init(seed, n):
+    # mesmos índices do init='random' do KMeans do scikit-learn com k = 2 (choice sem
+    # reposição com pesos uniformes)
+    return check_random_state(seed).choice(n, size=2, replace=False, p=np.ones(n) / n)
+
+_random_init_cached = lru_cache(maxsize=4096)(_random_init)
+
+def random_init(seed, n):
+    '''
+    Índices dos centros iniciais do KMeans(init='random', random_state=seed) com k = 2 em n
+    linhas. Com uma seed inteira eles só dependem de n e ficam em cache; com None usam o
+    gerador global, como o KMeans.
+    '''
+    if seed is None: return _random_init(seed, n)
+    return _random_init_cached(int(seed), n)
+
+def _nearest_of_two(x, centers, group):
+    # rótulo 0/1 do centro mais próximo de cada linha (empate fica no 0, como no scikit-learn);
+    # os produtos com todos os centros saem de um único GEMM e cada linha pega os do seu grupo
+    flat = centers.reshape(-1, centers.shape[-1])
+    distance = np.einsum('ij,ij->i', flat, flat) - 2 * (x @ flat.T)
+    columns = 2 * group
+    rows = np.arange(len(x))
+    return (distance[rows, columns + 1] < distance[rows, columns]).astype(int)
+
+def lloyd_2means(data, rows, offsets, init, max_iter=10, tol=1e-4):
+    '''
+    KMeans com k = 2 (Lloyd) de vários grupos de linhas de data ao mesmo tempo, seguindo o
+    KMeans(algorithm='lloyd', n_init=1) do scikit-learn: dados centrados em cada grupo,
+    parada por rótulos iguais ou deslocamento dos centros abaixo de tol * média das
+    variâncias, centro vazio movido para o ponto mais distante e um passo E final quando a
+    convergência não é estrita. Cada grupo para de iterar na sua própria convergência.
+
+    Parameters
+    ----------
+    data: ndarray
+        Dados (n x p)
+    rows: ndarray
+        Linhas de data de todos os grupos, concatenadas
+    offsets: ndarray
+        O grupo j são as linhas rows[offsets[j]:offsets[j + 1]]
+    init: ndarray
+        Centros iniciais, grupos x 2 x p
+    max_iter: int
+        Máximo de iterações
+    tol: float
+        Tolerância relativa do deslocamento dos centros
+
+    Return
+    ------
+    labels: ndarray
+        Rótulo 0/1 de cada linha, na ordem de rows
+    centers: ndarray
+        Centros finais, grupos x 2 x p
+    '''
+    offsets = np.asarray(offsets)
+    sizes = np.diff(offsets)
+    n_groups = len(sizes)
+    group = np.repeat(np.arange(n_groups), sizes)
+    x = np.asarray(data, dtype=float)[rows]
+    mean = np.add.reduceat(x, offsets[:-1], axis=0) / sizes[:, None]
+    x = x - mean[group]
+    centers = np.asarray(init, dtype=float) - mean[:, None, :]
+    tol = tol * (np.add.reduceat(x * x, offsets[:-1], axis=0) / sizes[:, None]).mean(axis=1)
+
+    labels = np.full(len(rows), -1)
+    active = np.ones(n_groups, dtype=bool)
+    strict = np.zeros(n_groups, dtype=bool)
+    for _ in range(max_iter):
+        new_labels = np.where(active[group], _nearest_of_two(x, centers, group), labels)
+        key = 2 * group + new_labels
+        counts = np.bincount(key, minlength=2 * n_groups).reshape(n_groups, 2)
+        indicator = np.zeros((2 * n_groups, len(x)))
+        indicator[key, np.arange(len(x))] = 1
+        sums = (indicator @ x).reshape(n_groups, 2, -1)
+        for g in np.flatnonzero(active & (counts == 0).any(axis=1)):
+            # centro vazio recebe o ponto mais distante do seu centro atual
+            members = np.flatnonzero(group == g)
+            far = members[np.argmax(((x[members] - centers[g, new_labels[members]]) ** 2).sum(axis=1))]
+            empty = np.flatnonzero(counts[g] == 0)[0]
+            sums[g, new_labels[far]] -= x[far]; counts[g, new_labels[far]] -= 1
+            sums[g, empty] = x[far]; counts[g, empty] = 1
+        with np.errstate(invalid='ignore'):
+            updated = sums / counts[..., None]
+        shift = ((updated - centers) ** 2).sum(axis=(1, 2))
+        changed = np.bincount(group, weights=new_labels != labels, minlength=n_groups) > 0
+        centers[active] = updated[active]
+        strict |= active & ~changed
+        active &= changed & (shift > tol)
+        labels = new_labels
+        if not active.any(): break
+    # passo E final nos grupos sem convergência estrita, para os rótulos baterem com os centros
+    final = ~strict[group]
+    labels[final] = _nearest_of_two(x, centers, group)[final]
+    return labels, centers + mean[:, None, :]
+
+@dataclass(frozen=True)
+class XMeansState:
+    '''
+    Resultado de um XMeans.fit que pode ser reaproveitado na janela seguinte.
+
+    Parameters
+    ----------
+    assets: tuple
+        Tickers das linhas de data usadas no fit
+    top: ndarray
+        Rótulo do KMeans inicial (k_min clusters) de cada ativo
+    top_centers: ndarray
+        Centros do KMeans inicial
+    cluster: ndarray
+        Rótulo final do X-Means de cada ativo
+    '''
+    assets: tuple
+    top: np.ndarray
+    top_centers: np.ndarray
+    cluster: np.ndarray
+
+
+class WarmStart:
+    '''
+    Traduz um XMeansState da janela anterior em centros iniciais para os KMeans da janela
+    atual. Os ativos são alinhados pelo ticker; ativos novos não têm rótulo anterior.
+    '''
+    __slots__ = ('state', 'data', 'same_assets', 'top', 'cluster')
+
+    def __init__(self, state, assets, data):
+        self.state = state
+        self.data = data
+        self.same_assets = tuple(state.assets) == tuple(assets)
+        position = {asset: j for j, asset in enumerate(state.assets)}
+        previous = np.array([position.get(asset, -1) for asset in assets], dtype=int)
+        known = previous >= 0
+        self.top = np.where(known, np.asarray(state.top)[previous], -1)
+        self.cluster = np.where(known, np.asarray(state.cluster)[previous], -1)
+
+    def top_centers(self, k):
+        """ Centros iniciais do KMeans com k clusters, None se não der para aproveitar o estado """
+        if self.same_assets and np.shape(self.state.top_centers) == (k, self.data.shape[1]):
+            return np.asarray(self.state.top_centers)
+        # com outro universo os centros anteriores estao em outra base de colunas, entao os
+        # centros sao as medias das linhas atuais agrupadas pelos rotulos anteriores
+        centers = [self.data[self.top == g] for g in range(k)]
+        if any(len(c) == 0 for c in centers): return None
+        return np.vstack([c.mean(axis=0) for c in centers])
+
+    def split_centers(self, members):
+        """ Centros iniciais da divisão em 2 das linhas members: o maior cluster anterior
+        entre elas contra o restante; None se elas estavam todas em um único cluster """
+        previous = self.cluster[members]
+        labels, counts = np.unique(previous[previous >= 0], return_counts=True)
+        if len(labels) < 2: return None
+        main = previous == labels[np.argmax(counts)]
+        rest = (previous >= 0) & ~main
+        return np.vstack([self.data[members[main]].mean(axis=0), self.data[members[rest]].mean(axis=0)])
+
+
+class SubClusterRelabel:
+    '''
+    Mapa de índices usado para juntar os rótulos dos sub-clusters de cada cluster inicial
+    em um único vetor de rótulos, em O(n) com um único gather.
+
+    Parameters
+    ----------
+    labels: ndarray
+        Rótulo do KMeans inicial de cada elemento
+    n_sub: list
+        Quantidade de sub-clusters de cada cluster inicial
+    '''
+    __slots__ = ('order', 'offsets')
+
+    def __init__(self, labels, n_sub):
+        # posições dos elementos agrupadas por cluster inicial, na ordem original dentro de
+        # cada cluster, a mesma ordem de data[clusters == i] usada no fit
+        self.order = np.argsort(labels, kind='stable')
+        self.offsets = np.concatenate(([0], np.cumsum(n_sub)[:-1])).astype(int)
+        if np.bincount(labels, minlength=len(n_sub)).size != len(n_sub):
+            raise ValueError("mergeResult: rótulos fora dos clusters iniciais")
+
+    def gather(self, sub_labels):
+        '''
+        Recebe o vetor de rótulos (1, ..., m) de cada cluster inicial e devolve o vetor de
+        rótulos únicos na ordem original dos elementos
+        '''
+        merged = np.empty(len(self.order), dtype=int)
+        merged[self.order] = np.concatenate([np.asarray(sub) + offset for sub, offset in zip(sub_labels, self.offsets)])
+        return merged
+
+class SplitTree:
+    '''
+    Árvore das divisões em 2 avaliadas pelo X-Means, preenchida nível a nível por
+    XMeans.grow_split_tree e percorrida por XMeans.replay_split_tree.
+
+    Cada nó é um sub-cluster com seu tamanho, o bic com que a divisão é comparada, a divisão
+    avaliada (rótulos 0/1 das linhas, centros e bic') e os filhos (-1 quando não há).
+
+    Parameters
+    ----------
+    capacity: int
+        Quantidade máxima de nós; cada nó interno tira ao menos uma linha dos seus
+        descendentes ou tem dois filhos, então 3 * n + k0 basta
+    p: int
+        Dimensão dos dados
+    '''
+    __slots__ = ('size', 'bic', 'bic_split', 'centers', 'left', 'right', 'block', 'offset', 'labels', 'n_nodes')
+
+    def __init__(self, capacity, p):
+        self.size = np.zeros(capacity, dtype=int)
+        self.bic = np.full(capacity, np.nan)
+        self.bic_split = np.full(capacity, np.nan)
+        self.centers = np.full((capacity, 2, p), np.nan)
+        self.left = np.full(capacity, -1)
+        self.right = np.full(capacity, -1)
+        # rótulos da divisão do nó: labels[block][offset:offset + size]
+        self.block = np.full(capacity, -1)
+        self.offset = np.zeros(capacity, dtype=int)
+        self.labels = []
+        self.n_nodes = 0
+
+    def add(self, sizes, bic):
+        """ Cria nós com os tamanhos e bics dados e devolve os índices deles """
+        nodes = np.arange(self.n_nodes, self.n_nodes + len(sizes))
+        self.size[nodes] = sizes
+        self.bic[nodes] = bic
+        self.n_nodes += len(sizes)
+        return nodes
+
+    def record(self, nodes, offsets, labels, centers, bic_split):
+        """ Guarda as divisões de um nível; as linhas do nó nodes[j] são labels[offsets[j]:offsets[j + 1]] """
+        self.block[nodes] = len(self.labels)
+        self.offset[nodes] = offsets[:-1]
+        self.labels.append(labels)
+        self.centers[nodes] = centers
+        self.bic_split[nodes] = bic_split
+
+    def link(self, nodes, kept, children):
+        """ kept indexa os pares (nó, lado) com filho: 2 * j para a esquerda e 2 * j + 1 para a direita """
+        parent, side = nodes[kept // 2], kept % 2
+        self.left[parent[side == 0]] = children[side == 0]
+        self.right[parent[side == 1]] = children[side == 1]
+
+    def labels_of(self, node):
+        start = self.offset[node]
+        return self.labels[self.block[node]][start:start + self.size[node]]
+
+
+class CenterRenumberError(IndexError):
+    '''
+    XMeans.update_center pediu um centro que a lista ainda não tem. Acontece no X-Means
+    original para algumas seeds (a renumeração k1/k2 pula posições); é um IndexError para
+    quem já tratava o erro antigo.
+    '''
+
 
 class XMeans:
-    def __init__(self, k_min=2, k_max=10, max_iter=100):
+    def __init__(self, k_min=2, k_max=10, max_iter=100, split_engine=None):
         #self.data = data
         self.k_min = k_min
         self.k_max = k_max
         self.max_iter = max_iter
+        # None divide os clusters um a um como o X-Means original; 'kmeans' e 'lloyd' avaliam
+        # as divisões nível a nível (KMeans do scikit-learn ou Lloyd em NumPy), com o mesmo
+        # resultado para uma seed inteira fixa. Com seed=None eles sorteiam uma seed inteira do
+        # gerador global e rodam com ela (ver fit): o resultado é o do X-Means original com essa
+        # seed, não o do original com seed=None, que consome o gerador global em outra ordem
+        self.split_engine = split_engine
 
     def bic(self, x, centers, q, ignore_covar):
         lnl = self.likehood(x, centers, ignore_covar)
@@ -48,43 +371,25 @@ class XMeans:
         return bic
 
     def likehood(self, x, centers, ignore_covar):
-        n = x.shape[0]; p = x.shape[1]
-        if n <= 2: return np.nan, np.nan
-        cov_x = np.cov(x, rowvar=False)
-        if p == 1: 
-            inversa = 1 / np.array(cov_x).flatten()
-            determi = np.array(cov_x).flatten()
-        else:
-            if ignore_covar:
-                inversa = np.diag(1 / np.diag(cov_x))
-                determi = np.prod(np.diag(cov_x))
-            else:
-                inversa = np.linalg.inv(cov_x)   # inverse matrix of "cov_x"
-                y = cholesky(cov_x, lower=False) # Cholesky decomposition
-                determi = np.prod(np.diag(y))    # # vx = t(y) %*% y, where y is triangular, # then, det(vx) = det(t(y)) * det(y)
-        t1 = -p/2 * 1.837877066 # 1.837... = log(2 * 3.1415...)
-        t2 = -np.log(determi) / 2
-        xmu = x - centers
-        if p == 1:
-            s = np.sum(xmu**2 * inversa)
-        else:
-            def tx_inv_vx_x(row, inversa):
-                return np.dot(np.dot(row, inversa), row)
-            s = sum(tx_inv_vx_x(row, inversa) for row in xmu)
-        t3 = -s / 2
-        ll = (t1 + t2) * n + t3.ravel() #log likelihood
-        return ll, determi
+        if x.shape[0] <= 2: return np.nan, np.nan
+        lnl, determi = group_loglik(x, np.zeros(x.shape[0], dtype=int), np.atleast_2d(centers), 1, ignore_covar)
+        return lnl[0:1], determi[0]
+
+    def likehood_split(self, x, labels, centers, ignore_covar):
+        """ Log-verossimilhança dos dois filhos de uma divisão em uma única chamada """
+        lnl, determi = group_loglik(x, labels, centers, 2, ignore_covar)
+        lnl = [lnl[g:g + 1] if not np.isnan(lnl[g]) else np.nan for g in range(2)]
+        return lnl, list(determi)
 
     def bic_linha(self, x, kmeans, q, ignore_covar):
+        labels = kmeans.labels_
         #pegar cluster 0
-        clj1 = x[kmeans.labels_ == 0]
+        clj1 = x[labels == 0]
         #pegar cluster 1
-        clj2 = x[kmeans.labels_ == 1]
+        clj2 = x[labels == 1]
 
-        #calcular likehood1
-        lnl1, determi1 = self.likehood(clj1, kmeans.cluster_centers_[0], ignore_covar)
-        #calcular likehood2
-        lnl2, determi2 = self.likehood(clj2, kmeans.cluster_centers_[1], ignore_covar)
+        #calcular likehood dos dois clusters de uma vez
+        (lnl1, lnl2), (determi1, determi2) = self.likehood_split(x, labels, kmeans.cluster_centers_, ignore_covar)
 
         #pegar n1 do cluster 0
         n1 = clj1.shape[0]
@@ -124,32 +429,21 @@ class XMeans:
                 z.append(sub_centers[1, :])
             else:
                 #print(center[i-1])
+                if i - 1 >= len(center):
+                    raise CenterRenumberError(f'update_center: centro {i} pedido com {len(center)} centros (k1={k1}, k2={k2})')
                 z.append(center[i-1])
         return z
 
     def merge_result(self, kmeans, clsub, ik):
         cluster = kmeans.labels_
-        centers = []
-        size = []
+        centers = [clsub[i][1] for i in range(ik)]
+        size = [clsub[i][2] for i in range(ik)]
         lnl = []
         determinante = []
-        k = 0
-        for i in range(ik):
-            k += len(clsub[i][2])
-
-        for i in range(ik, 0, -1):
-            xsub = clsub[i-1][0]
-            iki = ik -(i) +1
-            centers.append(clsub[iki-1][1])
-            size.append(clsub[iki-1][2])
-                
-            for j in range(len(clsub[i-1][2]), 0, -1):
-                xsub[xsub == j] = k
-                k = k - 1
-            
-            indices = np.where(cluster == (i-1))  
-            cluster[indices] = xsub
-        if k != 0: raise ValueError("mergeResult: assertion failed (k = 0)...")
+        # O rótulo j do sub-cluster do cluster Ci vira offset[i] + j, onde offset[i] é a
+        # quantidade de sub-clusters dos clusters anteriores a Ci
+        relabel = SubClusterRelabel(cluster, [len(clsub[i][2]) for i in range(ik)])
+        cluster[:] = relabel.gather([clsub[i][0] for i in range(ik)])
         return {
             "cluster": cluster,
             "centers": centers,
@@ -158,20 +452,62 @@ class XMeans:
             "size": size
             }
 
-    def fit(self, data, seed, ignore_covar = True):
+    def kmeans(self, data, n_clusters, seed, init=None):
+        # init=None usa a inicializacao aleatoria original; um array de centros vem do
+        # estado da janela anterior (warm start)
+        if init is None: init = 'random'
+        return KMeans(n_clusters=n_clusters, random_state=seed, max_iter=10, init=init, n_init=1).fit(data)
+
+    def fit(self, data, seed, ignore_covar = True, state = None, assets = None):
+        """ X-Means; state (XMeansState da janela anterior) inicializa os KMeans a partir
+        dos clusters anteriores e assets identifica as linhas de data para alinhar o estado """
+        if seed is None and self.split_engine is not None:
+            # a ordem dos sorteios nível a nível não é a do loop original; uma única seed
+            # sorteada do gerador global mantém o fit reprodutível por np.random.seed
+            seed = int(np.random.randint(np.iinfo(np.int32).max))
+        if assets is None: assets = range(data.shape[0])
+        assets = tuple(assets)
+        warm = WarmStart(state, assets, data) if state is not None else None
         # Passo 1 - prepare the p-dimensional data
         p = data.shape[1]
         q = 2 * p if ignore_covar else p * (p + 3) / 2
-        clsub = []
 
         # Passo 1 - set initial number of clusters to be k0
         if self.k_min < 2: self.k_min = 2
 
         # Passo 2 - Apply KMeans to all data with k = k0. We name the
         # name the divided clusters as C1, C2, C3, ..., Ck0
-        kmeans = KMeans(n_clusters=self.k_min, random_state=seed, max_iter=10, init='random', n_init=1).fit(data)
+        kmeans = self.kmeans(data, self.k_min, seed, warm.top_centers(self.k_min) if warm else None)
         clusters = kmeans.labels_
+        top_labels = clusters.copy(); top_centers = kmeans.cluster_centers_.copy()
+
+        # Passos 3 a 9 - divisões em 2 de cada cluster inicial, uma a uma ou nível a nível
+        split = self.split_clusters if self.split_engine is None else self.split_clusters_batched
+        clsub = split(data, kmeans, seed, q, ignore_covar, warm)
+
+        #end of for  
+        # Passo 10 - The 2-division procedure for initial k0 divided clusters is
+        # completed. We renumber all clusters identifications such that they 
+        # become unique
+        xcl = self.merge_result(kmeans, clsub, self.k_min)
+
+        # Passo 11 - Output the cluster identification number to which 
+        # each element is allocated, the center of each cluster, the log
+        # likehood of each cluster, and the number of elements in each 
+        # cluster 
+        return {
+                "cluster": xcl["cluster"],
+                "centers": xcl["centers"],
+                "lnl": xcl["lnL"],
+                "size": xcl["size"],
+                "state": XMeansState(assets, top_labels, top_centers, xcl["cluster"].copy())
+            }
 
+    def split_clusters(self, data, kmeans, seed, q, ignore_covar, warm):
+        """ Divisões em 2 de cada cluster inicial, uma chamada do KMeans por vez na ordem do
+        X-Means original; devolve (rótulos, centros, tamanhos) dos sub-clusters de cada um """
+        clusters = kmeans.labels_
+        clsub = []
         # Passo 3 - Repeat the following procedure from step 4 to step 9
         # by setting i = 1, 2, 3, ..., k0
         for i in range(self.k_min):
@@ -183,9 +519,11 @@ class XMeans:
             sub_center  = kmeans.cluster_centers_[i] # --> Center do cluster Ci
             zi_center = sub_center
             yi_cluster = np.ones(len(data[clusters == i]) ,dtype=int)
+            members = np.flatnonzero(clusters == i)  # linhas de data em sub_cluster
             while True:
                 if len(sub_cluster) == 1: break
-                sub_kmeans = KMeans(n_clusters=2, random_state=seed, max_iter=10, init='random', n_init=1).fit(sub_cluster) # --> Ci_1 e Ci_2
+                sub_init = warm.split_centers(members) if warm else None
+                sub_kmeans = self.kmeans(sub_cluster, 2, seed, sub_init) # --> Ci_1 e Ci_2
                 sub_clusters = sub_kmeans.labels_
                 sub_centerss = sub_kmeans.cluster_centers_
 
@@ -205,14 +543,13 @@ class XMeans:
                     sub_clusters = np.where(sub_clusters == 1, k2, sub_clusters)  # Substitui 1 por k2
                     sub_clusters = np.where(sub_clusters == 0, k1, sub_clusters)  # Substitui 0 por k1
                     #Substituir valores em v com base em k1
-                    for i in range(len(yi_cluster)):
-                        if yi_cluster[i] == 1:
-                            yi_cluster[i] = sub_clusters[i % len(sub_clusters)]
+                    relabel = np.flatnonzero(yi_cluster == 1)
+                    yi_cluster[relabel] = sub_clusters[relabel % len(sub_clusters)]
 
                     zi_center  = self.update_center(zi_center, k1, k2, sub_centerss)
                     clj2 = sub_cluster[sub_kmeans.labels_ == 1]
                     clj2_center = sub_centerss[1]; lnl2 = bic_linha['lnl'][1]; bic2 = bic_linha['bic'][1]
-                    stack.append(  (clj2, clj2_center, lnl2, bic2, k2)  )
+                    stack.append(  (clj2, clj2_center, lnl2, bic2, k2, members[sub_kmeans.labels_ == 1])  )
 
                 # Passo 8 - if BIC < BIC' clusters are not longer divided. Extract 
                 # the stacked data which is stored in step 7 and set Ci <- Ci_2
@@ -225,11 +562,13 @@ class XMeans:
                         lnl = elementos[2]
                         bic = elementos[3]
                         k1 = elementos[4]
+                        members = elementos[5]
                         k2 = k2
                         continue
                     break
                 
                 sub_cluster = sub_cluster[sub_kmeans.labels_ == 0]
+                members = members[sub_kmeans.labels_ == 0]
                 sub_kmeans.cluster_centers_ = sub_centerss[0]  
                 
                 # Passo 9 - The 2-division procedure for Ci is completed. We renumber the
@@ -240,22 +579,119 @@ class XMeans:
             size = np.bincount(yi_cluster, minlength=yi_cluster.max() + 1)[1:]
             clsub.append(  (yi_cluster, zi_center, size)  )
 
-        #end of for  
-        # Passo 10 - The 2-division procedure for initial k0 divided clusters is
-        # completed. We renumber all clusters identifications such that they 
-        # become unique
-        xcl = self.merge_result(kmeans, clsub, self.k_min)
-
-        # Passo 11 - Output the cluster identification number to which 
-        # each element is allocated, the center of each cluster, the log
-        # likehood of each cluster, and the number of elements in each 
-        # cluster 
-        return {
-                "cluster": xcl["cluster"],
-                "centers": xcl["centers"],
-                "lnl": xcl["lnL"],
-                "size": xcl["size"]
-            }
+        return clsub
+
+    def split_clusters_batched(self, data, kmeans, seed, q, ignore_covar, warm):
+        """ Mesmo resultado de split_clusters para uma seed inteira (fit troca None por uma
+        seed sorteada antes de chegar aqui): a árvore de divisões é avaliada nível a nível
+        (grow_split_tree) e depois percorrida na ordem do loop original (replay_split_tree) """
+        tree, roots = self.grow_split_tree(data, kmeans.labels_, kmeans.cluster_centers_, seed, q, ignore_covar, warm)
+        return [self.replay_split_tree(tree, root, kmeans.cluster_centers_[i]) for i, root in enumerate(roots)]
+
+    def split_level(self, data, rows, offsets, seed, warm):
+        """ KMeans com k = 2 de todos os sub-clusters de um nível; o sub-cluster j são as linhas
+        rows[offsets[j]:offsets[j + 1]] de data. Devolve os rótulos 0/1 na ordem de rows e
+        os centros (sub-clusters x 2 x p) """
+        bounds = list(zip(offsets[:-1], offsets[1:]))
+        init = [warm.split_centers(rows[a:b]) if warm else None for a, b in bounds]
+        if self.split_engine == 'kmeans':
+            labels = np.empty(len(rows), dtype=int)
+            centers = np.empty((len(bounds), 2, data.shape[1]))
+            for j, (a, b) in enumerate(bounds):
+                sub_kmeans = self.kmeans(data[rows[a:b]], 2, seed, init[j])
+                labels[a:b] = sub_kmeans.labels_
+                centers[j] = sub_kmeans.cluster_centers_
+            return labels, centers
+        # 'lloyd': o mesmo init='random' do KMeans (ou o warm start) e Lloyd em NumPy
+        start = np.stack([init[j] if init[j] is not None else data[rows[a + random_init(seed, b - a)]]
+                          for j, (a, b) in enumerate(bounds)])
+        return lloyd_2means(data, rows, offsets, start, max_iter=10)
+
+    def bic_linha_level(self, data, rows, offsets, labels, centers, q, ignore_covar):
+        """ bic_linha de todas as divisões de um nível com uma única chamada de group_loglik;
+        devolve bic1 e bic2 (sub-clusters x 2) e o bic geral de cada divisão """
+        n_split = len(offsets) - 1
+        group = 2 * np.repeat(np.arange(n_split), np.diff(offsets)) + labels
+        lnl, determi = group_loglik(data[rows], group, centers.reshape(2 * n_split, -1), 2 * n_split, ignore_covar)
+        lnl = lnl.reshape(n_split, 2); determi = determi.reshape(n_split, 2)
+        n = np.bincount(group, minlength=2 * n_split).reshape(n_split, 2)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            distance = np.sqrt(np.einsum('ij,ij->i', centers[:, 0] - centers[:, 1], centers[:, 0] - centers[:, 1]))
+            beta = np.where(np.isnan(determi).any(axis=1), 0, distance / np.sqrt(determi.sum(axis=1)))
+            alpha = 0.5 / stats.norm.cdf(beta)
+            bic = -2 * lnl + q * np.log(n)
+            total = -2 * lnl.sum(axis=1) + 2 * q * np.log(n.sum(axis=1)) - 2 * n.sum(axis=1) * np.log(alpha)
+        return bic, total
+
+    def grow_split_tree(self, data, clusters, centers, seed, q, ignore_covar, warm):
+        """ Avalia nível a nível todas as divisões que o loop de split_clusters pode visitar.
+
+        O bic de cada nó só depende dos ancestrais: na raiz é o bic do cluster inicial, o
+        filho da esquerda herda o bic do pai e o da direita recebe o bic2 da divisão do pai.
+        Então a decisão de cada nó (dividir, parar ou, no empate, descer sem empilhar) sai
+        de uma comparação vetorizada e cada nível custa um split_level e um bic_linha_level.
+        Nós com um único elemento não são divididos (no loop original eles encerram o cluster).
+        """
+        k = centers.shape[0]
+        sizes = np.bincount(clusters, minlength=k)
+        tree = SplitTree(len(data) * 3 + k, data.shape[1])
+        # raízes: linhas de cada cluster inicial na ordem original, como data[clusters == i]
+        rows = np.argsort(clusters, kind='stable')
+        with np.errstate(divide='ignore', invalid='ignore'):
+            bic = -2 * group_loglik(data, clusters, centers, k, ignore_covar)[0] + q * np.log(sizes)
+        roots = tree.add(sizes, bic)
+        nodes = roots
+        while len(nodes):
+            size = tree.size[nodes]
+            split = size > 1
+            nodes, rows, size, bic = nodes[split], rows[np.repeat(split, size)], size[split], tree.bic[nodes[split]]
+            if not len(nodes): break
+            offsets = np.concatenate(([0], np.cumsum(size)))
+            labels, centers = self.split_level(data, rows, offsets, seed, warm)
+            bic_split, total = self.bic_linha_level(data, rows, offsets, labels, centers, q, ignore_covar)
+            # Passos 7 e 8 - divide (bic > bic'), para (bic < bic' ou bic' nan) ou, no
+            # empate, segue para o filho da esquerda sem empilhar o da direita
+            accept = bic > total
+            descend = ~((bic < total) | np.isnan(total))
+            tree.record(nodes, offsets, labels, centers, total)
+            # filhos do nível seguinte: linhas agrupadas por filho, na ordem original
+            node_of_row = np.repeat(np.arange(len(nodes)), size)
+            keep = np.where(labels == 0, descend[node_of_row], accept[node_of_row])
+            child = 2 * node_of_row + labels
+            order = np.argsort(child[keep], kind='stable')
+            rows = rows[keep][order]
+            kept = np.flatnonzero(np.stack([descend, accept], axis=1).ravel())
+            child_bic = np.stack([bic, bic_split[:, 1]], axis=1).ravel()[kept]
+            children = tree.add(np.bincount(child[keep], minlength=2 * len(nodes))[kept], child_bic)
+            tree.link(nodes, kept, children)
+            nodes = children
+        return tree, roots
+
+    def replay_split_tree(self, tree, root, center):
+        """ Percorre a árvore de divisões de um cluster inicial na ordem do loop de
+        split_clusters (filho da esquerda primeiro, pilha com os da direita) e refaz a
+        renumeração dos rótulos e dos centros; nenhuma divisão é recalculada aqui """
+        yi_cluster = np.ones(tree.size[root], dtype=int)
+        zi_center = center
+        stack = []; k1 = 1; k2 = k1 + 1; node = root
+        while True:
+            if tree.size[node] == 1: break
+            bic, bic_split = tree.bic[node], tree.bic_split[node]
+            if bic > bic_split:
+                sub_clusters = np.where(tree.labels_of(node) == 1, k2, k1)
+                relabel = np.flatnonzero(yi_cluster == 1)
+                yi_cluster[relabel] = sub_clusters[relabel % len(sub_clusters)]
+                zi_center = self.update_center(zi_center, k1, k2, tree.centers[node])
+                stack.append((tree.right[node], k2))
+            if bic < bic_split or np.isnan(bic_split):
+                if stack:
+                    node, k1 = stack.pop()
+                    continue
+                break
+            node = tree.left[node]
+            k2 += 1
+        size = np.bincount(yi_cluster, minlength=yi_cluster.max() + 1)[1:]
+        return yi_cluster, zi_center, size
 
     # Função para calcular o risco total do portfólio
     def portfolio_risk(self, weights, covariance_matrix):
@@ -267,61 +703,219 @@ class XMeans:
 
     # Função objetivo para minimizar diferenças nas contribuições de risco
     def clustering_risk_parity_objective(self, weights, covariance_matrix, clusters, k, Nk):
-        portfolio_risk_ = self.portfolio_risk(weights, covariance_matrix)
-        mrc = self.marginal_risk_contribution(weights, covariance_matrix, portfolio_risk_)
-        trc = np.sum(weights * mrc)
-        rc = weights * mrc / trc  # Contribuição de risco normalizada
-        # calcular a funcao objetivo
-        penalty = 0
-        for i, label in enumerate(clusters):
-            target = (1 / k) * (1 / Nk[label])
-            penalty += (rc[i] - target)**2
+        target = (1 / k) * (1 / np.array([Nk[label] for label in clusters]))
+        penalty, _ = self.risk_parity_loss(weights, np.asarray(covariance_matrix), target)
         return penalty
 
-    def peso(self, cluster, cov):
-        """ Pesos do portfólio (Clustering Risk Parity) """
+    # Vetor alvo das contribuições de risco: cada cluster recebe 1/k do risco, dividido
+    # igualmente entre seus Nk ativos
+    def risk_parity_target(self, clusters):
+        unique_labels, inverse, counts = np.unique(clusters, return_inverse=True, return_counts=True)
+        return 1 / (len(unique_labels) * counts[inverse])
+
+    # Função objetivo vetorizada e seu gradiente analítico, para o SLSQP não precisar de
+    # diferenças finitas. Com s = Σw, v = w'Σw, rc = w * s / v e e = rc - alvo:
+    #   f(w)  = e'e
+    #   ∇f(w) = 2 * [ (s * e + Σ(w * e)) / v - 2 * s * (e'(w * s)) / v² ]
+    def risk_parity_loss(self, weights, covariance_matrix, target):
+        sigma_w = covariance_matrix @ weights
+        variance = weights @ sigma_w
+        rc = weights * sigma_w / variance  # Contribuição de risco normalizada
+        error = rc - target
+        grad = 2 * ((sigma_w * error + covariance_matrix @ (weights * error)) / variance
+                    - 2 * sigma_w * (error @ (weights * sigma_w)) / variance ** 2)
+        return error @ error, grad
+
+    @profiling.profiled('xmeans.optimization')
+    def peso(self, cluster, cov, initial_weights=None):
+        """ Pesos do portfólio (Clustering Risk Parity)
+
+        initial_weights permite partir dos pesos da janela anterior (warm start) em vez
+        dos pesos iguais
+        """
         np.random.seed(42)
         # Dados do clustering
         clusters = cluster  # Resultado do clustering
-        unique_clusters = np.unique(clusters)
-
-        # Número de clusters e ativos por cluster
-        unique_labels, counts = np.unique(clusters, return_counts=True)
-        k = len(unique_labels)
-        Nk = dict(zip(unique_labels, counts))
         n_assets = len(clusters)
-        
+        # Alvo de contribuição de risco de cada ativo, calculado uma única vez
+        target = self.risk_parity_target(clusters)
+
         # Restrições
-        initial_weights = np.ones(n_assets) / n_assets  # Pesos iniciais iguais
+        if initial_weights is None:
+            initial_weights = np.ones(n_assets) / n_assets  # Pesos iniciais iguais
+        else:
+            initial_weights = np.clip(np.asarray(initial_weights, dtype=float), 0, 1)
+            initial_weights = initial_weights / initial_weights.sum()
         constraints = (
-            {"type": "eq", "fun": lambda w: np.sum(w) - 1},  # Soma dos pesos = 1
+            {"type": "eq", "fun": lambda w: np.sum(w) - 1, "jac": lambda w: np.ones_like(w)},  # Soma dos pesos = 1
         )
         bounds = [(0, 1) for _ in range(n_assets)] 
         # Matriz de covariância
-        covariance_matrix = cov
+        covariance_matrix = np.asarray(cov, dtype=float)
         # Otimização
         result = minimize(
-            self.clustering_risk_parity_objective,
+            self.risk_parity_loss,
             initial_weights,
-            args=(covariance_matrix, clusters, k, Nk),
+            args=(covariance_matrix, target),
             method="SLSQP",
+            jac=True,
             constraints=constraints,
             bounds=bounds,
             #options={'disp':True}
         )
 
+        profiling.count('xmeans.optimization', nit=result.nit, nfev=result.nfev)
         # Pesos finais
         optimized_weights = result.x
         return optimized_weights
 
-def main(data, cov, asset, seed):
-    correlation = get_correlation(data)
-    distance_corr = calc_distance(correlation)
-    distance_euclidean = squareform(pdist(distance_corr, metric='euclidean'))
-    X_train = distance_euclidean
-    xm = XMeans()
-    xms = xm.fit(X_train, seed)
-    w = xm.peso(xms['cluster'], cov)
+def warm_start_weights(previous, asset):
+    '''
+    Alinha os pesos da janela anterior aos ativos da janela atual para servir de ponto
+    inicial do SLSQP. Ativos que entraram no universo recebem o peso igual 1/n e o vetor
+    é renormalizado para somar 1.
+
+    Parameters
+    ----------
+    previous: series pandas
+        Pesos da janela anterior indexados pelo ticker
+    asset: list
+        Tickers da janela atual
+    '''
+    if previous is None: return None
+    w0 = pd.Series(previous, dtype=float).reindex(asset).fillna(1 / len(asset)).to_numpy()
+    return w0 / w0.sum()
+
+def _fit_labels(args):
+    # um fit do ensemble; o fit original falha no update_center para algumas seeds
+    # (CenterRenumberError), e essas rodadas ficam de fora do consenso; qualquer outro erro sobe
+    data, seed, ignore_covar, split_engine = args
+    try:
+        return XMeans(split_engine=split_engine).fit(data, seed, ignore_covar)["cluster"]
+    except CenterRenumberError:
+        return None
+
+def coassociation(runs):
+    '''
+    Matriz de coassociação: fração das rodadas em que cada par de ativos caiu no mesmo cluster.
+
+    Parameters
+    ----------
+    runs: list
+        Rótulos de cluster de cada rodada (um array de tamanho n por rodada)
+
+    Return
+    ------
+    C: ndarray
+        Matriz n x n com valores em [0, 1] e diagonal 1
+    '''
+    runs = [np.unique(labels, return_inverse=True)[1].ravel() for labels in runs]
+    n = len(runs[0])
+    C = np.zeros((n, n))
+    for labels in runs:
+        # indicadora n x k da rodada; indicadora @ indicadora' marca os pares no mesmo cluster
+        onehot = np.zeros((n, labels.max() + 1))
+        onehot[np.arange(n), labels] = 1
+        C += onehot @ onehot.T
+    return C / len(runs)
+
+def consensus_clusters(C, threshold=0.5):
+    '''
+    Clusters de consenso: average linkage sobre 1 - C cortada na distância 1 - threshold, ou
+    seja, pares que ficaram juntos em mais de threshold das rodadas tendem a ficar juntos.
+
+    Return
+    ------
+    cluster: ndarray
+        Rótulo 0, ..., k - 1 de cada ativo
+    '''
+    from scipy.cluster.hierarchy import linkage, fcluster
+    distance = squareform(np.clip(1 - C, 0, 1), checks=False)
+    labels = fcluster(linkage(distance, method='average'), t=1 - threshold, criterion='distance')
+    return np.unique(labels, return_inverse=True)[1].ravel()
+
+def ensemble_fit(data, seeds, ignore_covar=True, max_workers=None, executor='thread', threshold=0.5,
+                 split_engine=None):
+    '''
+    Roda XMeans.fit com várias seeds em paralelo e combina as rodadas em clusters de consenso.
+
+    O KMeans do scikit-learn libera o GIL na maior parte do tempo, então um pool de threads já
+    paraleliza as rodadas; executor='process' usa processos. Com max_workers=1 as rodadas
+    rodam em sequência no próprio thread, sem pool (o caso dentro dos processos do
+    WalkForwardEngine, que já paraleliza as janelas).
+
+    Rodadas em que o fit original falha (CenterRenumberError) ficam de fora do consenso; a
+    quantidade vai em 'dropped' e um RuntimeWarning é emitido.
+
+    Parameters
+    ----------
+    data: ndarray
+        Dados do X-Means (matriz de distância n x n)
+    seeds: list
+        Uma seed inteira por rodada
+    ignore_covar: bool
+        Repassado para XMeans.fit
+    max_workers: int
+        Tamanho do pool; None usa o padrão do executor (min(32, os.cpu_count() + 4) threads ou
+        os.cpu_count() processos)
+    executor: str
+        'thread' ou 'process'
+    threshold: float
+        Fração mínima de rodadas juntas para o consenso (ver consensus_clusters)
+    split_engine: str
+        Repassado para XMeans (None, 'kmeans' ou 'lloyd')
+
+    Return
+    ------
+    result: dict
+        'cluster' (consenso), 'coassociation', 'runs' (rótulos das rodadas que terminaram) e
+        'dropped' (quantidade de rodadas descartadas)
+    '''
+    from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+    tasks = [(data, seed, ignore_covar, split_engine) for seed in seeds]
+    if max_workers == 1:
+        fitted = list(map(_fit_labels, tasks))
+    else:
+        pool = {'thread': ThreadPoolExecutor, 'process': ProcessPoolExecutor}[executor]
+        with pool(max_workers=max_workers) as workers:
+            fitted = list(workers.map(_fit_labels, tasks))
+    runs = [labels for labels in fitted if labels is not None]
+    dropped = len(fitted) - len(runs)
+    if not runs:
+        raise RuntimeError(f'nenhuma das {len(fitted)} rodadas do ensemble do X-Means terminou')
+    if dropped:
+        warnings.warn(f'ensemble do X-Means: {dropped} de {len(fitted)} rodadas descartadas (CenterRenumberError)',
+                      RuntimeWarning, stacklevel=2)
+    C = coassociation(runs)
+    return {"cluster": consensus_clusters(C, threshold), "coassociation": C, "runs": runs, "dropped": dropped}
+
+def main(data, cov=None, asset=None, seed=None, metric='euclidean', previous_weights=None, state=None,
+         return_state=False, n_runs=None, max_workers=None, executor='thread', split_engine=None):
+    # data pode ser o DataFrame de retornos ou um pipeline.WindowContext ja calculado;
+    # metric e uma de pipeline.DISTANCE_METRICS (o pdist, 'euclidean')
+    context = pipeline.as_context(data, metric)
+    if cov is None: cov = context.covariance
+    if asset is None: asset = list(context.assets)
+    X_train = context.square_distance()
+    # split_engine avalia as divisoes do X-Means nivel a nivel (ver XMeans.grow_split_tree)
+    xm = XMeans(split_engine=split_engine)
+    if n_runs:
+        # ensemble: n_runs fits com seeds sorteadas a partir de seed (ou do estado global) e
+        # clusters de consenso; o estado da janela anterior nao e usado
+        rng = np.random if seed is None else np.random.RandomState(seed)
+        seeds = rng.randint(np.iinfo(np.int32).max, size=n_runs)
+        with profiling.stage('xmeans.fit'):
+            xms = ensemble_fit(X_train, seeds.tolist(), max_workers=max_workers, executor=executor,
+                               split_engine=split_engine)
+        w = xm.peso(xms['cluster'], cov, warm_start_weights(previous_weights, asset))
+        if return_state: return w, None
+        return w
+    # state (XMeansState da janela anterior) inicializa os KMeans com os clusters anteriores
+    with profiling.stage('xmeans.fit'):
+        xms = xm.fit(X_train, seed, state=state, assets=asset)
+    # previous_weights (pesos da janela anterior por ticker) sao o ponto inicial do SLSQP
+    w = xm.peso(xms['cluster'], cov, warm_start_weights(previous_weights, asset))
+    if return_state: return w, xms['state']
     return w
  
  
\ No newline at end of file